@@ -35,6 +35,7 @@ This module has Following Features:
         "wizard/avalara_salestax_address_validate_view.xml",
         "views/avalara_salestax_view.xml",
         "views/avalara_salestax_data.xml",
+        "data/ir_cron.xml",
         "views/partner_view.xml",
         "views/product_view.xml",
         "views/account_invoice_action.xml",
@@ -42,6 +43,9 @@ This module has Following Features:
         "views/sale_order_view.xml",
         "views/sale_order_action.xml",
         "views/account_tax_view.xml",
+        "views/avalara_reconcile_view.xml",
+        "views/avalara_backfill_view.xml",
+        "views/avalara_metrics_view.xml",
         "report/sale_order_templates.xml",
         # "views/res_config_settings_view.xml",
     ],
@@ -7,4 +7,8 @@ from . import account_invoice
 from . import account_tax
 from . import res_config_settings
 from . import res_company
+from . import res_country
 from . import avatax_rest_api
+from . import avalara_reconcile
+from . import avalara_backfill
+from . import avalara_metrics
@@ -1,8 +1,16 @@
+import hashlib
+import json
 import logging
 import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
 from odoo import api, fields, models, _
 import odoo.addons.decimal_precision as dp
 from odoo.exceptions import UserError
+from odoo.tools import create_index
+from .avatax_lock import lock_documents, try_lock_documents
+from .avatax_profiler import avatax_profiled
+from .avatax_result import AvaTaxResult
 
 
 _logger = logging.getLogger(__name__)
@@ -40,27 +48,13 @@ class AccountInvoice(models.Model):
 
         For this to work properly, the "exemption_lock" is no longer supported.
         """
+        Exemption = self.env["res.partner.exemption"]
         for invoice in self:
-            invoice_partner = invoice.partner_id.commercial_partner_id
-            ship_to_address = invoice.shipping_add_id
-            # Find an exemption address matching the Country + State
-            # of the Delivery address
-            exemption_addresses = (
-                invoice_partner | invoice_partner.child_ids
-            ).filtered("property_tax_exempt")
-            exemption_address_naive = exemption_addresses.filtered(
-                lambda a: a.country_id == ship_to_address.country_id
-                and (
-                    a.state_id == ship_to_address.state_id
-                    or invoice_partner.property_exemption_country_wide
-                )
-            )[:1]
-            # Force Company to get the correct values form the Property fields
-            exemption_address = exemption_address_naive.with_context(
-                force_company=invoice.company_id.id
+            exemption = Exemption._find_exemption(
+                invoice.partner_id, invoice.company_id, invoice.shipping_add_id
             )
-            invoice.exemption_code = exemption_address.property_exemption_number
-            invoice.exemption_code_id = exemption_address.property_exemption_code_id
+            invoice.exemption_code = exemption.exemption_number
+            invoice.exemption_code_id = exemption.exemption_code_id
 
     @api.onchange("warehouse_id")
     def onchange_warehouse_id(self):
@@ -110,6 +104,97 @@ class AccountInvoice(models.Model):
     warehouse_id = fields.Many2one("stock.warehouse", "Warehouse")
     disable_tax_calculation = fields.Boolean("Disable Avatax Tax calculation")
     avatax_amount = fields.Float(digits=dp.get_precision("Sale Price"))
+    avatax_fingerprint = fields.Char(
+        "Avatax Data Fingerprint",
+        readonly=True,
+        copy=False,
+        help="Fingerprint of the data used for the last Avatax tax computation",
+    )
+    avatax_commit_date = fields.Datetime(
+        "Committed to Avatax On",
+        readonly=True,
+        copy=False,
+        help="Last time the invoice was committed to Avatax with the REST API",
+    )
+    avatax_dirty_date = fields.Datetime(
+        "Avatax Computation Pending Since",
+        readonly=True,
+        copy=False,
+        index=True,
+        help="Lines changed, and the taxes will be computed in background",
+    )
+
+    @api.model
+    def create(self, vals):
+        invoice = super().create(vals)
+        if vals.get("invoice_line_ids"):
+            invoice._avatax_mark_dirty()
+        return invoice
+
+    @api.multi
+    def write(self, vals):
+        if "avatax_fingerprint" not in vals and {
+            "invoice_line_ids",
+            "shipping_add_id",
+            "fiscal_position_id",
+        } & set(vals):
+            # The readonly fingerprint reset by the onchange is not saved
+            vals = dict(vals, avatax_fingerprint=False)
+        res = super().write(vals)
+        if vals.get("invoice_line_ids"):
+            self._avatax_mark_dirty()
+        return res
+
+    def _avatax_mark_dirty(self):
+        """
+        With a debounced immediate calculation, flag the draft invoices
+        for a background tax computation, instead of contacting Avatax
+        on every line change.
+        """
+        drafts = self.filtered(
+            lambda x: x.state == "draft" and x.type in ["out_invoice", "out_refund"]
+        )
+        debounced = {
+            company: company.get_avatax_config_company()._is_calculation_debounced()
+            for company in drafts.mapped("company_id")
+        }
+        dirty = drafts.filtered(lambda x: debounced[x.company_id])
+        if dirty:
+            super(AccountInvoice, dirty).write(
+                {"avatax_dirty_date": fields.Datetime.now()}
+            )
+
+    @api.model
+    def _cron_avatax_compute_dirty(self, limit=100):
+        """
+        Compute the taxes of the invoices with line changes older than
+        the configured delay. The users see the new totals when the
+        documents are reloaded.
+        """
+        invoices = self.search(
+            [("avatax_dirty_date", "!=", False), ("state", "=", "draft")],
+            order="avatax_dirty_date",
+            limit=limit,
+        )
+        now = datetime.now()
+        for invoice in invoices:
+            avatax_config = invoice.company_id.get_avatax_config_company()
+            delay = timedelta(seconds=avatax_config.immediate_calculation_delay)
+            if invoice.avatax_dirty_date + delay > now:
+                continue
+            if try_lock_documents(invoice):
+                continue  # Being computed in another session, retry later
+            try:
+                with self.env.cr.savepoint():
+                    invoice._avatax_compute_taxes(commit_avatax=False)
+            except Exception as error:
+                _logger.warning(
+                    "Avatax background computation failed for invoice %s: %s",
+                    invoice.id,
+                    error,
+                )
+            super(AccountInvoice, invoice).write({"avatax_dirty_date": False})
+        return True
 
     def _compute_amount(self):
         super()._compute_amount()
@@ -140,13 +225,56 @@ class AccountInvoice(models.Model):
             for line in inv.invoice_line_ids:
                 line.tax_amt = 0
 
-    @api.multi
+    @api.model_cr
+    def init(self):
+        super().init()
+        # Used to find refunds origin invoices
+        create_index(
+            self._cr, "account_invoice_avatax_number_index", self._table, ["number"]
+        )
+
     def get_origin_tax_date(self):
-        if self.invoice_doc_no:
-            orig_invoice = self.search([("name", "=", self.invoice_doc_no)])
-            return orig_invoice.invoice_date
-        # else:
-        return False
+        """
+        Returns the tax date of a refund: the date of its origin invoice.
+        It is resolved once, and stored as the refund Tax Invoice Date.
+        """
+        if not self.invoice_doc_no:
+            return False
+        if not self.invoice_date:
+            self._avatax_set_refund_tax_dates()
+        return self.invoice_date
+
+    def _avatax_set_refund_tax_dates(self):
+        """
+        Sets the Tax Invoice Date of the refunds missing it,
+        from their origin invoice, in one query for all the refunds.
+        """
+        # Refunds not saved yet, such as in onchanges, can't be updated
+        refunds = self.filtered(
+            lambda x: isinstance(x.id, int)
+            and x.type == "out_refund"
+            and x.state == "draft"
+            and x.invoice_doc_no
+            and not x.invoice_date
+        )
+        if not refunds:
+            return
+        self.env.cr.execute(
+            """
+            UPDATE account_invoice refund
+            SET invoice_date = origin.date_invoice,
+                write_uid = %s,
+                write_date = NOW() AT TIME ZONE 'UTC'
+            FROM account_invoice origin
+            WHERE refund.id IN %s
+              AND origin.number = refund.invoice_doc_no
+              AND origin.company_id = refund.company_id
+              AND origin.type = 'out_invoice'
+              AND origin.date_invoice IS NOT NULL
+            """,
+            [self.env.uid, tuple(refunds.ids)],
+        )
+        refunds.invalidate_cache(["invoice_date", "write_uid", "write_date"])
 
     def _get_avatax_doc_type(self, commit=False):
         self.ensure_one()
@@ -171,37 +299,57 @@ class AccountInvoice(models.Model):
         ]
         return [x for x in lines if x]
 
+    def _avatax_is_profiling(self):
+        """ Profile the Avatax computations for these invoices """
+        return bool(
+            self.env.context.get("avatax_profile")
+            or self[:1].company_id.id
+            in self.env["avalara.salestax"]._get_profiling_company_ids()
+        )
+
+    @avatax_profiled
     def _avatax_compute_tax(self, commit=False):
         """ Contact REST API and recompute taxes for a Sale Order """
         self and self.ensure_one()
         Tax = self.env["account.tax"]
         avatax_config = self.company_id.get_avatax_config_company()
+        # With tax reporting disabled the document is not committed,
+        # and gets no commit date: a backfill can commit it later
         commit = commit and not avatax_config.disable_tax_reporting
         doc_type = self._get_avatax_doc_type(commit)
         tax_date = self.get_origin_tax_date() or self.date_invoice
         taxable_lines = self._avatax_prepare_lines(doc_type)
-        tax_result = avatax_config.create_transaction(
-            self.date_invoice or fields.Date.today(),
-            self.number,
-            doc_type,
-            self.partner_id,
-            self.warehouse_id.partner_id or self.company_id.partner_id,
-            self.partner_shipping_id or self.partner_id,
-            taxable_lines,
-            self.user_id,
-            self.exemption_code or None,
-            self.exemption_code_id.code or None,
-            commit,
-            tax_date,
-            self.invoice_doc_no,
-            self.location_code or "",
-            is_override=self.type == "out_refund",
-            currency_id=self.currency_id,
-            ignore_error=300 if commit else None,
+        # Reuse the Sales Order computation, if done for the same lines
+        tax_result = not commit and self._avatax_get_sale_order_result(
+            taxable_lines
         )
+        if not tax_result:
+            tax_result = avatax_config.create_transaction(
+                self.date_invoice or fields.Date.today(),
+                self.number,
+                doc_type,
+                self.partner_id,
+                self.company_id.get_avatax_origin(self.warehouse_id),
+                self.partner_shipping_id or self.partner_id,
+                taxable_lines,
+                self.user_id,
+                self.exemption_code or None,
+                self.exemption_code_id.code or None,
+                commit,
+                tax_date,
+                self.invoice_doc_no,
+                self.location_code or "",
+                is_override=self.type == "out_refund",
+                currency_id=self.currency_id,
+                ignore_error=300 if commit else None,
+            )
         # If commiting, and document exists, try unvoiding it
         # Error number 300 = GetTaxError, Expected Saved|Posted
-        if commit and tax_result.get("number") == 300:
+        if (
+            commit
+            and isinstance(tax_result, dict)
+            and tax_result.get("number") == 300
+        ):
             _logger.info(
                 "Document %s (%s) already exists in Avatax. "
                 "Should be a voided transaction. "
@@ -211,13 +359,12 @@ class AccountInvoice(models.Model):
             )
             avatax_config.unvoid_transaction(self.number, doc_type)
             avatax_config.commit_transaction(self.number, doc_type)
+            self.avatax_commit_date = fields.Datetime.now()
             return tax_result
 
-        tax_result_lines = {int(x["lineNumber"]): x for x in tax_result["lines"]}
         for line in self.invoice_line_ids:
-            tax_result_line = tax_result_lines.get(line.id)
-            if tax_result_line:
-                rate = tax_result_line.get("rate", 0.0)
+            if line.id in tax_result:
+                rate = tax_result.get_rate(line.id)
                 tax = Tax.get_avalara_tax(rate, doc_type)
                 if tax and not (tax == line.invoice_line_tax_ids.filtered("is_avatax")):
                     non_avataxes = line.invoice_line_tax_ids.filtered(
@@ -226,10 +373,137 @@ class AccountInvoice(models.Model):
                     line.invoice_line_tax_ids = non_avataxes | tax
                 # Tax amount must be + sign, both for Invoices and Credit Notes
                 # Appropriate sign will be taken care of, based on type of doc
-                line.tax_amt = abs(tax_result_line["tax"])
-        self.avatax_amount = abs(tax_result["totalTax"])
+                line.tax_amt = abs(tax_result.get_tax(line.id))
+        self.avatax_amount = abs(tax_result.total_tax)
+        if commit:
+            self.avatax_commit_date = fields.Datetime.now()
         return tax_result
 
+    @api.model
+    def _avatax_get_address_values(self, partner):
+        """ Returns the partner address values read by the tax request """
+        return SimpleNamespace(
+            street=partner.street,
+            city=partner.city,
+            zip=partner.zip,
+            country_id=SimpleNamespace(code=partner.country_id.code),
+            state_id=SimpleNamespace(code=partner.state_id.code),
+        )
+
+    def _avatax_get_commit_request(self, avatax_config):
+        """
+        Returns the AvaTaxRESTService.get_tax() keyword arguments
+        to commit a posted invoice. Only plain values are used,
+        so that the request can be sent from another thread.
+        """
+        self.ensure_one()
+        doc_type = self._get_avatax_doc_type(commit=True)
+        partner = self.partner_id
+        if not partner.customer_code:
+            partner.generate_cust_code()
+        ship_from = self.company_id.get_avatax_origin(self.warehouse_id)
+        ship_to = self.partner_shipping_id or self.partner_id
+        return {
+            "company_code": avatax_config.company_code,
+            "doc_date": self.date_invoice,
+            "doc_type": doc_type,
+            "partner_code": partner.customer_code,
+            "doc_code": self.number,
+            "origin": ship_from["address"],
+            "destination": self._avatax_get_address_values(ship_to),
+            "received_lines": self._avatax_prepare_lines(doc_type),
+            "exemption_no": self.exemption_code or None,
+            "customer_usage_type": self.exemption_code_id.code or None,
+            "salesman_code": self.user_id.name or None,
+            "commit": True,
+            "invoice_date": self.get_origin_tax_date() or self.date_invoice,
+            "reference_code": self.invoice_doc_no,
+            "location_code": self.location_code or "",
+            "currency_code": self.currency_id.name,
+            "vat_id": partner.vat_id or None,
+            "is_override": self.type == "out_refund",
+            "ignore_error": 300,
+        }
+
+    @api.model
+    def _avatax_hash(self, payload):
+        """ Returns a hash for a JSON serializable payload """
+        return hashlib.sha1(
+            json.dumps(payload, default=str).encode("utf-8")
+        ).hexdigest()
+
+    @api.model
+    def _avatax_get_line_fingerprint(
+        self,
+        partner,
+        ship_from,
+        ship_to,
+        exemption_number,
+        exemption_code_name,
+        currency,
+        line,
+        tax_date,
+    ):
+        """
+        Returns a fingerprint of the data sent to Avatax for a document line.
+        Used to match Invoice lines with the Sales Order lines they come from.
+        The tax date is included: the taxes of an Invoice dated after
+        its Sales Order may use other rates.
+        """
+        return self._avatax_hash(
+            [
+                fields.Date.to_date(tax_date),
+                partner.customer_code,
+                ship_from.avatax_address_hash,
+                ship_to.avatax_address_hash,
+                exemption_number or None,
+                exemption_code_name or None,
+                currency.name,
+                line["qty"],
+                currency.round(line["amount"]),
+                line["itemcode"],
+                line["tax_code"],
+                line["description"],
+            ]
+        )
+
+    def _avatax_get_sale_order_result(self, taxable_lines):
+        """
+        Returns an Avatax result built from the Sales Order lines results,
+        if every taxable Invoice line matches a computed Sales Order line.
+        Otherwise returns None, and Avatax needs to be called.
+        """
+        self.ensure_one()
+        if self.type != "out_invoice" or not taxable_lines:
+            return None
+        ship_from = self.warehouse_id.partner_id or self.company_id.partner_id
+        ship_to = self.partner_shipping_id or self.partner_id
+        line_ids, taxes, rates = [], [], []
+        for line in taxable_lines:
+            sale_line = line["id"].sale_line_ids
+            if len(sale_line) != 1 or not sale_line.avatax_fingerprint:
+                return None
+            fingerprint = self._avatax_get_line_fingerprint(
+                self.partner_id,
+                ship_from,
+                ship_to,
+                self.exemption_code,
+                self.exemption_code_id.code,
+                self.currency_id,
+                line,
+                self.date_invoice or fields.Date.context_today(self),
+            )
+            if fingerprint != sale_line.avatax_fingerprint:
+                return None
+            line_ids.append(line["id"].id)
+            taxes.append(sale_line.tax_amt)
+            rates.append(sum(sale_line.tax_id.filtered("is_avatax").mapped("amount")))
+        _logger.info(
+            "Invoice %s reuses the Avatax taxes computed for its Sales Order.",
+            self.id,
+        )
+        return AvaTaxResult(sum(taxes), line_ids, taxes, rates)
+
     def _has_avatax_tax(self):
         self.ensure_one()
         is_avatax_list = self.mapped("invoice_line_ids.invoice_line_tax_ids.is_avatax")
@@ -237,12 +511,15 @@ class AccountInvoice(models.Model):
 
     @api.multi
     def _avatax_compute_taxes(self, commit_avatax=False):
+        # At most one calculation in progress per invoice
+        lock_documents(self)
+        self._avatax_set_refund_tax_dates()
         for invoice in self:
             # The onchange invoice lines call get_taxes_values()
             # and applies it to the invoice's tax_line_ids
             # invoice.with_context(contact_avatax=True)._onchange_invoice_line_ids()
             if invoice._has_avatax_tax():
-                avatax_config = self.company_id.get_avatax_config_company()
+                avatax_config = invoice.company_id.get_avatax_config_company()
                 if avatax_config:
                     if "rest" in avatax_config.service_url:
                         avatax_result = invoice._avatax_compute_tax(
@@ -264,6 +541,90 @@ class AccountInvoice(models.Model):
                         for tax in taxes_grouped.values():
                             tax_lines += tax_lines.new(tax)
                         invoice.tax_line_ids = tax_lines
+                    if not commit_avatax:
+                        invoice.avatax_fingerprint = invoice._avatax_get_fingerprint()
+        return True
+
+    def _avatax_get_fingerprint(self):
+        """
+        Returns a fingerprint of the data sent to Avatax for tax computation.
+        If it is unchanged, the last computed taxes are still valid.
+        """
+        self.ensure_one()
+        ship_from = self.warehouse_id.partner_id or self.company_id.partner_id
+        ship_to = self.partner_shipping_id or self.partner_id
+        payload = [
+            self.type,
+            self.partner_id.customer_code,
+            ship_from.avatax_address_hash,
+            ship_to.avatax_address_hash,
+            self.date_invoice,
+            self.invoice_doc_no,
+            self.invoice_date,
+            self.exemption_code,
+            self.exemption_code_id.code,
+            self.location_code,
+            self.currency_id.name,
+            [
+                [
+                    line["id"].id,
+                    line["qty"],
+                    line["amount"],
+                    line["itemcode"],
+                    line["tax_code"],
+                    line["description"],
+                    line["tax_id"].ids,
+                ]
+                for line in self._avatax_prepare_lines()
+            ],
+        ]
+        return self._avatax_hash(payload)
+
+    def _avatax_is_precomputed(self):
+        """ Checks if the current taxes were computed for the current data """
+        self.ensure_one()
+        return bool(self.avatax_fingerprint) and (
+            self.avatax_fingerprint == self._avatax_get_fingerprint()
+        )
+
+    @api.model
+    def _cron_avatax_precompute_taxes(self, days=1, limit=200):
+        """
+        Compute, without commiting, the Avatax taxes for the draft invoices
+        due in the next days, so that posting them only needs
+        the commit call to Avatax.
+        Invoices failing the computation are left for the posting.
+        """
+        self = self.with_context(avatax_batch=True)
+        date_to = fields.Date.context_today(self) + timedelta(days=days)
+        invoices = self.search(
+            [
+                ("state", "=", "draft"),
+                ("type", "in", ["out_invoice", "out_refund"]),
+                ("date_invoice", "!=", False),
+                ("date_invoice", "<=", date_to),
+                ("disable_tax_calculation", "=", False),
+            ],
+            limit=limit,
+        )
+        invoices._avatax_set_refund_tax_dates()
+        count = 0
+        for invoice in invoices:
+            if not invoice._has_avatax_tax() or invoice._avatax_is_precomputed():
+                continue
+            if try_lock_documents(invoice):
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    invoice._avatax_compute_taxes(commit_avatax=False)
+                count += 1
+            except Exception as error:
+                _logger.warning(
+                    "Avatax tax precomputation failed for invoice %s: %s",
+                    invoice.id,
+                    error,
+                )
+        _logger.info("Avatax taxes precomputed for %d draft invoices", count)
         return True
 
     @api.multi
@@ -290,6 +651,7 @@ class AccountInvoice(models.Model):
         return super().compute_taxes()
 
     @api.multi
+    @avatax_profiled
     def action_invoice_open(self):
         avatax_config = self.company_id.get_avatax_config_company()
         if avatax_config and avatax_config.force_address_validation:
@@ -302,12 +664,17 @@ class AccountInvoice(models.Model):
         # , to ensure correct account moves
         # We can only commit to Avatax after validating the invoice
         # , because we need the generated Invoice number
-        self._avatax_compute_taxes(commit_avatax=False)
+        # Taxes already computed for the current data are not computed again
+        lock_documents(self)
+        self._avatax_set_refund_tax_dates()
+        to_compute = self.filtered(lambda x: not x._avatax_is_precomputed())
+        to_compute._avatax_compute_taxes(commit_avatax=False)
         super(AccountInvoice, self).action_invoice_open()
         self._avatax_compute_taxes(commit_avatax=True)
         return True
 
     @api.multi
+    @avatax_profiled
     def get_taxes_values(self, contact_avatax=False, commit_avatax=False):
         """
         Extends the standard method reponsible for computing taxes.
@@ -322,7 +689,10 @@ class AccountInvoice(models.Model):
         contact_avatax = (
             contact_avatax
             or self.env.context.get("contact_avatax")
-            or avatax_config.enable_immediate_calculation
+            or (
+                avatax_config.enable_immediate_calculation
+                and not avatax_config._is_calculation_debounced()
+            )
         )
         has_avatax = any(x.tax_id.is_avatax for x in self.tax_line_ids)
         if contact_avatax and self.type in ["out_invoice", "out_refund"] and has_avatax:
@@ -350,8 +720,8 @@ class AccountInvoice(models.Model):
             sign = self.type == "out_invoice" and 1 or -1
             lines = self._avatax_prepare_lines()
             if lines:
-                ship_from_address_id = (
-                    self.warehouse_id.partner_id or self.company_id.partner_id
+                ship_from_address_id = self.company_id.get_avatax_origin(
+                    self.warehouse_id
                 )
                 tax = avatax_id
 
@@ -382,7 +752,7 @@ class AccountInvoice(models.Model):
                     is_override=self.type == "out_refund",
                     currency_id=self.currency_id,
                 )
-                o_tax = tax_result.TotalTax
+                o_tax = tax_result.total_tax
 
                 if o_tax:
                     val = {
@@ -417,62 +787,37 @@ class AccountInvoice(models.Model):
                         tax_grouped[key]["amount"] += val["amount"]
                         tax_grouped[key]["base"] += val["base"]
 
-            for line in self.invoice_line_ids:
-                price_unit = line.price_unit * (1 - (line.discount or 0.0) / 100.0)
+            # The line taxes go through the same hooks as with the REST API,
+            # so that modules can add their amounts to the tax lines
+            for line in self.invoice_line_ids.filtered(
+                lambda x: x.account_id and not x.display_type
+            ):
                 taxes = line.invoice_line_tax_ids.compute_all(
-                    price_unit,
+                    line._get_tax_price_unit(),
                     self.currency_id,
                     line.quantity,
                     line.product_id,
                     self.partner_id,
                 )["taxes"]
                 for tax in taxes:
-                    val = {
-                        "invoice_id": self.id,
-                        "name": tax["name"],
-                        "tax_id": tax["id"],
-                        "amount": tax["amount"],
-                        "base": tax["base"],
-                        "manual": False,
-                        "sequence": tax["sequence"],
-                        "account_analytic_id": tax["analytic"]
-                        and line.account_analytic_id.id
-                        or False,
-                        "analytic_tag_ids": line.analytic_tag_ids.ids or False,
-                        "account_id": self.type in ("out_invoice", "in_invoice")
-                        and (tax["account_id"] or line.account_id.id)
-                        or (tax["refund_account_id"] or line.account_id.id),
-                    }
-
-                    # If the taxes generate moves on the same financial account as the invoice line,
-                    # propagate the analytic account from the invoice line to the tax line.
-                    # This is necessary in situations were (part of) the taxes cannot be reclaimed,
-                    # to ensure the tax move is allocated to the proper analytic account.
-                    if (
-                        not val.get("account_analytic_id")
-                        and line.account_analytic_id
-                        and val["account_id"] == line.account_id.id
-                    ):
-                        val["account_analytic_id"] = line.account_analytic_id.id
-
-                    key = avatax_id.get_grouping_key(val)
-                    if key not in tax_grouped:
-                        tax_grouped[key] = val
-                    else:
-                        tax_grouped[key]["amount"] += val["amount"]
-                        tax_grouped[key]["base"] += val["base"]
+                    val = self._prepare_tax_line_vals(line, tax)
+                    key = account_tax_obj.browse(tax["id"]).get_grouping_key(val)
+                    self._avatax_add_grouped_tax_vals(tax_grouped, key, val)
             return tax_grouped
         else:
             # REST API
             # Original get_taxes_values can't be cleanly extended
             # So it is reproduced here, it a small modification:
             # The price_unit can have a specific computation
-            tax_grouped = super(AccountInvoice, self).get_taxes_values()
+            # The lines are processed in a single pass,
+            # with the taxes and their grouping keys read once
             tax_grouped = {}
-            round_curr = self.currency_id.round
-            for line in self.invoice_line_ids:
-                if not line.account_id or line.display_type:
-                    continue
+            lines = self.invoice_line_ids.filtered(
+                lambda x: x.account_id and not x.display_type
+            )
+            tax_records = {x.id: x for x in lines.mapped("invoice_line_tax_ids")}
+            Tax = self.env["account.tax"]
+            for line in lines:
                 price_unit = line._get_tax_price_unit()
                 tax_ids = line.invoice_line_tax_ids.with_context(avatax_line=line)
                 taxes = tax_ids.compute_all(
@@ -482,16 +827,25 @@ class AccountInvoice(models.Model):
                     line.product_id,
                     self.partner_id,
                 )["taxes"]
-                Tax = self.env["account.tax"]
                 for tax in taxes:
                     val = self._prepare_tax_line_vals(line, tax)
-                    key = Tax.browse(tax["id"]).get_grouping_key(val)
-                    if key not in tax_grouped:
-                        tax_grouped[key] = val
-                        tax_grouped[key]["base"] = round_curr(val["base"])
-                    else:
-                        tax_grouped[key]["amount"] += val["amount"]
-                        tax_grouped[key]["base"] += round_curr(val["base"])
+                    tax_record = tax_records.get(tax["id"]) or Tax.browse(tax["id"])
+                    key = tax_record.get_grouping_key(val)
+                    self._avatax_add_grouped_tax_vals(tax_grouped, key, val)
+        return tax_grouped
+
+    def _avatax_add_grouped_tax_vals(self, tax_grouped, key, val):
+        """
+        Add the tax line values to the grouped tax values.
+        Extension point for modules needing to sum other amounts.
+        """
+        round_curr = self.currency_id.round
+        if key not in tax_grouped:
+            tax_grouped[key] = val
+            tax_grouped[key]["base"] = round_curr(val["base"])
+        else:
+            tax_grouped[key]["amount"] += val["amount"]
+            tax_grouped[key]["base"] += round_curr(val["base"])
         return tax_grouped
 
     @api.model
@@ -521,17 +875,46 @@ class AccountInvoice(models.Model):
 
     @api.multi
     def action_cancel(self):
+        """
+        Void the Avatax transactions before cancelling the invoices.
+        Voids are grouped by Avatax configuration and sent concurrently.
+        Invoices failing to void are not cancelled, and get the error
+        logged in their chatter, while the others are cancelled.
+        """
+        configs = {}
+        to_void = {}
         for invoice in self:
-            avatax_config = invoice.company_id.get_avatax_config_company()
+            company = invoice.company_id
+            if company not in configs:
+                configs[company] = company.get_avatax_config_company()
+            avatax_config = configs[company]
             if (
                 invoice.type in ["out_invoice", "out_refund"]
                 and invoice._has_avatax_tax()
                 and invoice.partner_id.country_id in avatax_config.country_ids
                 and invoice.state != "draft"
             ):
-                doc_type = invoice._get_avatax_doc_type(commit=True)
-                avatax_config.void_transaction(invoice.number, doc_type)
-        return super(AccountInvoice, self).action_cancel()
+                to_void.setdefault(avatax_config, self.browse())
+                to_void[avatax_config] |= invoice
+        failed = self.browse()
+        for avatax_config, invoices in to_void.items():
+            errors = avatax_config.void_transactions(invoices.mapped("number"))
+            for invoice in invoices:
+                error = errors.get(invoice.number)
+                if not error:
+                    continue
+                if len(self) == 1:
+                    raise UserError(error)
+                failed |= invoice
+                invoice.message_post(
+                    body=_("Avatax transaction could not be voided: %s") % error
+                )
+        if failed:
+            _logger.warning(
+                "Avatax void failed for invoices %s, not cancelled.",
+                ", ".join(failed.mapped("number")),
+            )
+        return super(AccountInvoice, self - failed).action_cancel()
 
 
 class AccountInvoiceLine(models.Model):
@@ -539,6 +922,13 @@ class AccountInvoiceLine(models.Model):
 
     tax_amt = fields.Float("Avalara Tax", help="Tax computed by Avalara")
 
+    @api.multi
+    def write(self, vals):
+        if {"price_unit", "discount", "invoice_line_tax_ids", "quantity"} & set(vals):
+            invoices = self.mapped("invoice_id").filtered("avatax_fingerprint")
+            invoices.write({"avatax_fingerprint": False})
+        return super().write(vals)
+
     @api.onchange("price_unit", "discount", "invoice_line_tax_ids", "quantity")
     def onchange_reset_avatax_amount(self):
         """
@@ -564,10 +954,7 @@ class AccountInvoiceLine(models.Model):
                 item_code = "upc:" + line.product_id.barcode
             else:
                 item_code = line.product_id.default_code
-            tax_code = (
-                line.product_id.tax_code_id.name
-                or line.product_id.categ_id.tax_code_id.name
-            )
+            tax_code = line.product_id.avatax_tax_code
             amount = sign * abs(line.quantity) * line._get_tax_price_unit()
             # Calculate discount amount
             discount_amount = 0.0
@@ -616,6 +1003,18 @@ class AccountInvoiceLine(models.Model):
         self.ensure_one()
         return self.price_unit * (1 - (self.discount or 0.0) / 100.0)
 
+    def _get_avatax_amount_vals(self, taxes, price):
+        """
+        Returns the line amounts to set, from the Tax.compute_all() result.
+        Extension point for modules needing other amounts from the same
+        computation, to avoid calling compute_all() again.
+        """
+        price_subtotal = taxes["total_excluded"] if taxes else self.quantity * price
+        return {
+            "price_subtotal": price_subtotal,
+            "price_total": taxes["total_included"] if taxes else price_subtotal,
+        }
+
     @api.one
     def _compute_price(self):
         """
@@ -625,8 +1024,8 @@ class AccountInvoiceLine(models.Model):
         REproduces the original code, since it was not extensible,
         and we need to add the current line to the context,
         so that Tax.compute_all can perform the specific calculations needed.
+        The original code is not called, to compute the taxes only once.
         """
-        super()._compute_price()
         currency = self.invoice_id and self.invoice_id.currency_id or None
         price = self.price_unit * (1 - (self.discount or 0.0) / 100.0)
         taxes = False
@@ -639,10 +1038,8 @@ class AccountInvoiceLine(models.Model):
                 product=self.product_id,
                 partner=self.invoice_id.partner_id,
             )
-        self.price_subtotal = price_subtotal_signed = (
-            taxes["total_excluded"] if taxes else self.quantity * price
-        )
-        self.price_total = taxes["total_included"] if taxes else self.price_subtotal
+        self.update(self._get_avatax_amount_vals(taxes, price))
+        price_subtotal_signed = self.price_subtotal
         if (
             self.invoice_id.currency_id
             and self.invoice_id.currency_id != self.invoice_id.company_id.currency_id
@@ -1,12 +1,30 @@
 import logging
+from datetime import timedelta
+import psycopg2
+from psycopg2 import errorcodes
+from psycopg2.extensions import TransactionRollbackError
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError
+from odoo.tools import mute_logger
 from .avalara_api import AvaTaxService, BaseAddress
 from .avatax_rest_api import AvaTaxRESTService
 
 
 _logger = logging.getLogger(__name__)
 
+# SOAP ship from addresses of this process, by service URL and address values
+SOAP_ORIGINS = {}
+
+
+
+class AvalaraTaxConflict(TransactionRollbackError):
+    """ A rate tax was created by a transaction committed after the current
+        one started. As a serialization failure, it makes Odoo retry the
+        request, that then finds the tax.
+    """
+
+    pgcode = errorcodes.SERIALIZATION_FAILURE
+
 
 class AccountTax(models.Model):
     """Inherit to implement the tax using avatax API"""
@@ -32,29 +50,95 @@ class AccountTax(models.Model):
             self._get_avalara_tax_domain(tax_rate, doc_type), limit=1
         )
         if tax and not tax.active:
-            tax.active = True
+            # Another transaction may be reactivating it:
+            # an inactive tax can still be used
+            try:
+                with self.env.cr.savepoint(), mute_logger("odoo.sql_db"):
+                    tax.active = True
+            except psycopg2.Error:
+                tax.invalidate_cache(["active"], tax.ids)
         if not tax:
-            tax_template = self.search(
-                self._get_avalara_tax_domain(0, doc_type), limit=1
+            tax = self._create_avalara_tax(tax_rate, doc_type)
+        return tax
+
+    @api.model
+    def _create_avalara_tax(self, tax_rate, doc_type):
+        """
+        Creates the tax for a new rate, copying the 0% Avatax tax.
+        When a concurrent transaction created the same tax, it is returned.
+        If it is not visible yet, the request is retried by Odoo.
+        """
+        tax_template = self.search(self._get_avalara_tax_domain(0, doc_type), limit=1)
+        name = self._get_avalara_tax_name(tax_rate, doc_type)
+        try:
+            with self.env.cr.savepoint(), mute_logger("odoo.sql_db"):
+                return tax_template.sudo().copy(
+                    default={"amount": tax_rate, "name": name}
+                )
+        except psycopg2.IntegrityError:
+            _logger.info("Avatax tax %s was created concurrently", name)
+        tax = self.with_context(active_test=False).search(
+            self._get_avalara_tax_domain(tax_rate, doc_type), limit=1
+        )
+        if not tax:
+            raise AvalaraTaxConflict(
+                "Avatax tax %s was created by a concurrent transaction" % name
             )
-            tax = tax_template.sudo().copy(default={"amount": tax_rate})
-            # If you get a unique constraint error here,
-            # check the data for your existing Avatax taxes.
-            tax.name = self._get_avalara_tax_name(tax_rate, doc_type)
         return tax
 
+    @api.model
+    def _cron_avatax_seed_rate_taxes(self, days=30, rates=None):
+        """
+        Creates ahead the taxes for the rates used by the recent Avalara
+        transactions, and for the given (rate, document type) list,
+        so that documents rarely need to create them while being posted.
+        The rates are computed from the jurisdiction details,
+        as when the taxes are computed.
+        """
+        rate_keys = set(rates or [])
+        date_to = fields.Date.context_today(self)
+        date_from = date_to - timedelta(days=days)
+        configs = self.env["avalara.salestax"].search(
+            [("disable_tax_calculation", "=", False)]
+        )
+        for avatax_config in configs.with_context(avatax_batch=True):
+            if "rest" not in avatax_config.service_url:
+                continue
+            avatax = avatax_config.get_avatax_rest_service()
+            transactions = avatax.list_transactions(
+                avatax_config.company_code,
+                date_from,
+                date_to,
+                include="Details",
+            )
+            for transaction in transactions:
+                for line in transaction.get("lines") or []:
+                    rate = avatax._get_line_rate(line)
+                    if rate:
+                        rate_keys.add((rate, transaction.get("type")))
+        created = 0
+        for rate, doc_type in rate_keys:
+            if self.with_context(active_test=False).search(
+                self._get_avalara_tax_domain(rate, doc_type), limit=1
+            ):
+                continue
+            self._create_avalara_tax(rate, doc_type)
+            created += 1
+        _logger.info(
+            "Avatax rate taxes: %d rates found, %d taxes created",
+            len(rate_keys),
+            created,
+        )
+        return True
+
     def _avatax_amount_compute_all(self):
         avatax_amount = None
         avatax_line = self.env.context.get("avatax_line")
         if avatax_line:
             avatax_result = self.env.context.get("avatax_result")
             if avatax_result:  # force Avatax returned amounts
-                avatax_result_lines = {
-                    int(x["lineNumber"]): x for x in avatax_result["lines"]
-                }
-                avatax_result_line = avatax_result_lines.get(avatax_line.id, {})
                 # Do not remove sign, as tax could be a negative amount
-                avatax_amount = avatax_result_line.get("tax", 0)
+                avatax_amount = avatax_result.get_tax(avatax_line.id)
             elif avatax_line.tax_amt:
                 # Use the last Avatax returned amount, or
                 # Recompute taxes using the configured
@@ -77,7 +161,7 @@ class AccountTax(models.Model):
 
         - avatax_line: the line record being computed.
           Its presence triggers the Avatax extension logic.
-        - avatax_result: the response from the Avatax service.
+        - avatax_result: the response from the Avatax service (AvaTaxResult).
           If available, will force the tax amounts returned.
           In not, uses odoo computation to estimate the taxes.
           The base amounts are kept, the tax amount is overriden.
@@ -143,6 +227,10 @@ class AccountTax(models.Model):
         is_override=False,
         currency_id=False,
     ):
+        if not isinstance(ship_from_address, (dict, type(None))):
+            ship_from_address = self.env["res.company"]._get_avatax_origin_payload(
+                ship_from_address
+            )
 
         currency_code = self.env.user.company_id.currency_id.name
         if currency_id:
@@ -183,7 +271,7 @@ class AccountTax(models.Model):
                     )
 
             # if not avatax_config.address_validation:
-            if not ship_from_address.date_validation:
+            if not ship_from_address["validated"]:
                 raise UserError(_("Please validate the company address."))
 
         if avatax_config.disable_tax_calculation:
@@ -201,6 +289,7 @@ class AccountTax(models.Model):
                 avatax_config.service_url,
                 avatax_config.request_timeout,
                 avatax_config.logging,
+                detail_level=avatax_config.detail_level,
             )
             tax_result = avatax_restpoint.get_tax(
                 avatax_config.company_code,
@@ -208,7 +297,7 @@ class AccountTax(models.Model):
                 doc_type,
                 partner.customer_code,
                 doc_code,
-                ship_from_address,
+                ship_from_address["address"],
                 shipping_address,
                 lines,
                 exemption_number,
@@ -231,21 +320,18 @@ class AccountTax(models.Model):
                 avatax_config.service_url,
                 avatax_config.request_timeout,
                 avatax_config.logging,
+                detail_level=avatax_config.detail_level,
             )
             avalara_obj.create_tax_service()
             addSvc = avalara_obj.create_address_service().addressSvc
-            origin = BaseAddress(
-                addSvc,
-                ship_from_address.street or None,
-                ship_from_address.street2 or None,
-                ship_from_address.city,
-                ship_from_address.zip,
-                ship_from_address.state_id and ship_from_address.state_id.code or None,
-                ship_from_address.country_id
-                and ship_from_address.country_id.code
-                or None,
-                0,
-            ).data
+            origin_key = (avatax_config.service_url,) + ship_from_address[
+                "soap_address"
+            ]
+            origin = SOAP_ORIGINS.get(origin_key)
+            if origin is None:
+                origin = SOAP_ORIGINS[origin_key] = BaseAddress(
+                    addSvc, *ship_from_address["soap_address"], AddressCode=0
+                ).data
             destination = BaseAddress(
                 addSvc,
                 shipping_address.street or None,
@@ -309,6 +395,7 @@ class AccountTax(models.Model):
                 avatax_config.service_url,
                 avatax_config.request_timeout,
                 avatax_config.logging,
+                detail_level=avatax_config.detail_level,
             )
             avalara_obj.create_tax_service()
             # Why the silent failure? Let explicitly raise the error.
@@ -9,13 +9,25 @@ from odoo import tools
 from odoo.tools.translate import _
 from odoo import fields
 from odoo.exceptions import UserError
+from .avatax_result import AvaTaxResult
 
 
 _logger = logging.getLogger(__name__)
 
+# Parsed WSDL clients, by URL, reused by every service created in the process
+_wsdl_clients = {}
+
 
 class AvaTaxService:
-    def __init__(self, username, password, url, timeout, enable_log=False):
+    def __init__(
+        self,
+        username,
+        password,
+        url,
+        timeout,
+        enable_log=False,
+        detail_level="Diagnostic",
+    ):
         self.username = (
             username  # This is the company's Development/Production Account number
         )
@@ -23,6 +35,7 @@ class AvaTaxService:
         self.url = url
         self.timeout = timeout
         self.is_log_enabled = enable_log
+        self.detail_level = detail_level
 
     def create_tax_service(self):
         self.taxSvc = self.service("tax")
@@ -44,7 +57,13 @@ class AvaTaxService:
         # If you want to fetch the WSDL from the server, use this instead:
         wsdl_url = "https://avatax.avalara.net/%s/%ssvc.wsdl" % (nameCap, nameCap)
 
-        svc = suds.client.Client(url=wsdl_url)
+        # Parsing the WSDL is slow: parse it once, and work on copies
+        wsdl_client = _wsdl_clients.get(wsdl_url)
+        if not wsdl_client:
+            wsdl_client = _wsdl_clients[wsdl_url] = suds.client.Client(
+                url=wsdl_url, timeout=self.timeout
+            )
+        svc = wsdl_client.clone()
         svc.set_options(service="%sSvc" % nameCap)
         svc.set_options(port="%sSvcSoap" % nameCap)
         svc.set_options(location="%s/%s/%sSvc.asmx" % (self.url, nameCap, nameCap))
@@ -186,8 +205,7 @@ class AvaTaxService:
         lineslist = []
         request = self.taxSvc.factory.create("GetTaxRequest")
         request.Commit = commit
-        request.DetailLevel = "Diagnostic"
-        # request.DetailLevel = 'Document'
+        request.DetailLevel = self.detail_level
         request.Discount = 0.0
         request.ServiceMode = "Automatic"  # service mode = Automatic/Local/Remote
         request.PaymentDate = doc_date
@@ -256,7 +274,7 @@ class AvaTaxService:
         # This helps trace the source of redundant API calls
         if self.is_log_enabled:
             _logger.info(result)
-        return result
+        return AvaTaxResult.from_soap(result, received_lines)
 
     def get_tax_history(self, company_code, doc_code, doc_type):
         request = self.taxSvc.factory.create("GetTaxHistoryRequest")
@@ -0,0 +1,275 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+from .avalara_salestax import BULK_MAX_WORKERS
+
+
+_logger = logging.getLogger(__name__)
+
+
+class AvalaraSalestaxBackfill(models.Model):
+    """
+    Commits to Avalara the posted invoices that never reached it.
+
+    Only the invoices found missing or not committed by a reconciliation
+    are taken: invoices posted before the commit date was recorded
+    may well be committed already, and commits are billable.
+    The invoices are processed in chunks, by increasing id, by a scheduled
+    action. After each chunk the progress is saved and committed, so that
+    the job can be paused, and resumes where it stopped.
+    """
+
+    _name = "avalara.salestax.backfill"
+    _description = "AvaTax Backfill"
+    _order = "id desc"
+
+    name = fields.Char(compute="_compute_name")
+    avatax_config_id = fields.Many2one(
+        "avalara.salestax",
+        "AvaTax Configuration",
+        required=True,
+        ondelete="cascade",
+        default=lambda self: self.env.user.company_id.get_avatax_config_company(),
+    )
+    company_id = fields.Many2one(
+        related="avatax_config_id.company_id", store=True, readonly=True
+    )
+    date_from = fields.Date("From", required=True)
+    date_to = fields.Date("To", required=True)
+    reconcile_id = fields.Many2one(
+        "avalara.salestax.reconcile",
+        "Reconciliation",
+        required=True,
+        help="Only the invoices found missing or not committed "
+        "in Avalara by this reconciliation are backfilled",
+    )
+    chunk_size = fields.Integer(default=200, required=True)
+    state = fields.Selection(
+        [
+            ("draft", "Draft"),
+            ("running", "Running"),
+            ("paused", "Paused"),
+            ("done", "Done"),
+        ],
+        default="draft",
+        readonly=True,
+        copy=False,
+    )
+    last_invoice_id = fields.Integer(
+        "Last Processed Invoice ID", readonly=True, copy=False
+    )
+    committed_count = fields.Integer("Committed", readonly=True, copy=False)
+    failed_count = fields.Integer("Failed", readonly=True, copy=False)
+    date_done = fields.Datetime("Finished On", readonly=True, copy=False)
+    line_ids = fields.One2many(
+        "avalara.salestax.backfill.line",
+        "backfill_id",
+        "Outcomes",
+        readonly=True,
+        copy=False,
+    )
+
+    @api.depends("avatax_config_id", "date_from", "date_to")
+    def _compute_name(self):
+        for backfill in self:
+            backfill.name = "%s %s - %s" % (
+                backfill.avatax_config_id.company_code or "",
+                backfill.date_from or "",
+                backfill.date_to or "",
+            )
+
+    @api.multi
+    def action_start(self):
+        for backfill in self:
+            avatax_config = backfill.avatax_config_id
+            if "rest" not in avatax_config.service_url:
+                raise UserError(_("Backfill is only supported with the REST API."))
+            if avatax_config.disable_tax_calculation:
+                raise UserError(_("Avatax tax calculation is disabled."))
+            if avatax_config.disable_tax_reporting:
+                raise UserError(_("Avatax tax commit is disabled."))
+            if backfill.reconcile_id.state != "done":
+                raise UserError(
+                    _("The reconciliation must be run before the backfill.")
+                )
+        self.write({"state": "running"})
+        return True
+
+    @api.multi
+    def action_pause(self):
+        self.filtered(lambda x: x.state == "running").write({"state": "paused"})
+        return True
+
+    @api.multi
+    def action_view_failures(self):
+        self.ensure_one()
+        action = self.env.ref(
+            "avatax_connector.action_avalara_salestax_backfill_line"
+        ).read()[0]
+        action["domain"] = [("backfill_id", "=", self.id), ("state", "=", "failed")]
+        return action
+
+    def _get_next_invoices(self):
+        """
+        Returns the next chunk of posted invoices never committed to Avatax
+        """
+        self.ensure_one()
+        query = """
+            SELECT inv.id
+            FROM account_invoice inv
+            WHERE inv.company_id = %s
+              AND inv.type IN ('out_invoice', 'out_refund')
+              AND inv.state IN ('open', 'in_payment', 'paid')
+              AND inv.number IS NOT NULL
+              AND inv.avatax_commit_date IS NULL
+              AND inv.date_invoice BETWEEN %s AND %s
+              AND inv.id > %s
+              AND inv.id IN (
+                SELECT invoice_id
+                FROM avalara_salestax_reconcile_line
+                WHERE reconcile_id = %s AND issue IN ('missing', 'uncommitted')
+              )
+            ORDER BY inv.id
+            LIMIT %s
+        """
+        params = [
+            self.company_id.id,
+            self.date_from,
+            self.date_to,
+            self.last_invoice_id,
+            self.reconcile_id.id,
+            self.chunk_size,
+        ]
+        self.env.cr.execute(query, params)
+        invoice_ids = [x[0] for x in self.env.cr.fetchall()]
+        return self.env["account.invoice"].browse(invoice_ids)
+
+    def _commit_invoices(self, invoices):
+        """
+        Commit the invoices to Avatax, sending the requests concurrently,
+        within the configured request rate limit.
+        Returns a dict mapping each invoice id to the error message,
+        or to None if it was committed.
+        """
+        self.ensure_one()
+        avatax_config = self.avatax_config_id.with_context(avatax_batch=True)
+        avatax = avatax_config.get_avatax_rest_service()
+        outcomes = {}
+        requests = []
+        for invoice in invoices:
+            try:
+                requests.append(
+                    (invoice.id, invoice._avatax_get_commit_request(avatax_config))
+                )
+            except UserError as error:
+                outcomes[invoice.id] = error.name
+
+        def commit(request):
+            invoice_id, kwargs = request
+            try:
+                return invoice_id, avatax.get_tax(**kwargs), None
+            except UserError as error:
+                return invoice_id, None, error.name
+            except Exception as error:
+                return invoice_id, None, str(error)
+
+        if requests:
+            workers = min(BULK_MAX_WORKERS, len(requests))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(commit, requests))
+        else:
+            results = []
+        committed = self.env["account.invoice"]
+        for invoice_id, result, error in results:
+            invoice = invoices.browse(invoice_id)
+            # Error number 300: the document already exists, and was voided
+            if not error and isinstance(result, dict):
+                doc_type = invoice._get_avatax_doc_type(commit=True)
+                try:
+                    avatax_config.unvoid_transaction(invoice.number, doc_type)
+                    avatax_config.commit_transaction(invoice.number, doc_type)
+                except UserError as unvoid_error:
+                    error = unvoid_error.name
+            outcomes[invoice_id] = error
+            if not error:
+                committed |= invoice
+        committed.write({"avatax_commit_date": fields.Datetime.now()})
+        return outcomes
+
+    def _run_chunk(self):
+        """
+        Process the next chunk of invoices, and save the progress.
+        Returns False when there are no more invoices to process.
+        """
+        self.ensure_one()
+        invoices = self._get_next_invoices()
+        if not invoices:
+            self.write({"state": "done", "date_done": fields.Datetime.now()})
+            return False
+        outcomes = self._commit_invoices(invoices)
+        self.env["avalara.salestax.backfill.line"].create(
+            [
+                {
+                    "backfill_id": self.id,
+                    "invoice_id": invoice_id,
+                    "state": "failed" if error else "committed",
+                    "message": error,
+                }
+                for invoice_id, error in outcomes.items()
+            ]
+        )
+        failed = len([x for x in outcomes.values() if x])
+        self.write(
+            {
+                "last_invoice_id": max(invoices.ids),
+                "committed_count": self.committed_count + len(outcomes) - failed,
+                "failed_count": self.failed_count + failed,
+            }
+        )
+        return True
+
+    @api.model
+    def _cron_run_backfills(self, max_duration=240):
+        """
+        Run the started backfills, chunk by chunk, for a limited time.
+        The progress is committed after each chunk.
+        """
+        start = time.time()
+        for backfill in self.search([("state", "=", "running")], order="id"):
+            while time.time() - start < max_duration:
+                if not backfill._run_chunk():
+                    break
+                self.env.cr.commit()
+                _logger.info(
+                    "Avatax backfill %s: %d committed, %d failed, up to invoice %d",
+                    backfill.name,
+                    backfill.committed_count,
+                    backfill.failed_count,
+                    backfill.last_invoice_id,
+                )
+                # Stop if paused meanwhile
+                backfill.invalidate_cache(["state"], backfill.ids)
+                if backfill.state != "running":
+                    break
+        return True
+
+
+class AvalaraSalestaxBackfillLine(models.Model):
+    _name = "avalara.salestax.backfill.line"
+    _description = "AvaTax Backfill Outcome"
+    _order = "id"
+
+    backfill_id = fields.Many2one(
+        "avalara.salestax.backfill",
+        "Backfill",
+        required=True,
+        index=True,
+        ondelete="cascade",
+    )
+    invoice_id = fields.Many2one("account.invoice", "Invoice", ondelete="cascade")
+    state = fields.Selection(
+        [("committed", "Committed"), ("failed", "Failed")], required=True, index=True
+    )
+    message = fields.Text()
@@ -0,0 +1,277 @@
+import logging
+import threading
+import weakref
+from datetime import datetime, timedelta
+from odoo import api, fields, models
+from odoo.tools import create_index
+
+
+_logger = logging.getLogger(__name__)
+
+# Recorded calls are buffered in memory, by database, and inserted
+# in one statement at the end of the transaction, or when the buffer is full
+CALL_BUFFER_SIZE = 50
+
+# Days the individual calls are kept after their hourly rollup
+CALL_RETENTION_DAYS = 7
+
+# Hours rolled up again on each run, to include the calls recorded late
+ROLLUP_TRAILING_HOURS = 3
+
+# Window, in minutes, of the recent calls giving the service status
+SERVICE_STATUS_WINDOW = 5
+
+_call_buffers = {}
+_call_buffer_lock = threading.Lock()
+# Cursors with a flush registered at the end of their transaction
+_flushing_cursors = weakref.WeakSet()
+
+
+def record_call(
+    config, operation, duration, doc_code=None, error_code=None, cached=False
+):
+    """ Record an Avatax service call of an Avatax configuration.
+        Safe to use from the bulk request threads.
+    """
+    row = (
+        config.id,
+        fields.Datetime.now(),
+        operation,
+        duration * 1000.0,
+        doc_code,
+        error_code and str(error_code),
+        cached,
+    )
+    pool = config.pool
+    cr = config.env.cr
+    with _call_buffer_lock:
+        buffer = _call_buffers.setdefault(pool.db_name, [])
+        buffer.append(row)
+        is_full = len(buffer) >= CALL_BUFFER_SIZE
+        register = cr not in _flushing_cursors
+        if register:
+            _flushing_cursors.add(cr)
+    if register:
+
+        def flush():
+            _flushing_cursors.discard(cr)
+            flush_calls(pool)
+
+        cr.after("commit", flush)
+        cr.after("rollback", flush)
+    if is_full:
+        flush_calls(pool)
+
+
+def flush_calls(pool):
+    """ Insert the buffered calls of a database, in a separate transaction,
+        so that they are kept when the current one is rolled back.
+        Failures are only logged.
+    """
+    with _call_buffer_lock:
+        rows = _call_buffers.pop(pool.db_name, [])
+    if not rows:
+        return
+    try:
+        with pool.cursor() as cr:
+            cr.execute(
+                "INSERT INTO avalara_salestax_call (config_id, call_date, "
+                "operation, duration, doc_code, error_code, cached) "
+                "VALUES " + ", ".join(["%s"] * len(rows)),
+                rows,
+            )
+    except Exception as error:
+        _logger.warning("Avatax call metrics not recorded: %s", error)
+
+
+class AvalaraSalestaxCall(models.Model):
+    """
+    Avatax service call, as recorded by the REST adapter.
+    Only kept a few days: the dashboard reads the hourly rollups.
+    """
+
+    _name = "avalara.salestax.call"
+    _description = "AvaTax Service Call"
+    _order = "call_date desc"
+    _log_access = False
+
+    config_id = fields.Many2one(
+        "avalara.salestax", "AvaTax Configuration", required=True, ondelete="cascade"
+    )
+    call_date = fields.Datetime("Date", required=True)
+    operation = fields.Char(required=True)
+    duration = fields.Float("Duration (ms)")
+    doc_code = fields.Char("Document Code")
+    error_code = fields.Char("Error Number")
+    cached = fields.Boolean(help="Result shared from an identical calculation")
+
+    @api.model_cr
+    def init(self):
+        create_index(
+            self._cr,
+            "avalara_salestax_call_config_date_index",
+            self._table,
+            ["config_id", "call_date"],
+        )
+
+
+class AvalaraSalestaxCallStat(models.Model):
+    """
+    Hourly rollup of the Avatax service calls, by operation
+    """
+
+    _name = "avalara.salestax.call.stat"
+    _description = "AvaTax Hourly Call Statistics"
+    _order = "hour desc, operation"
+
+    config_id = fields.Many2one(
+        "avalara.salestax",
+        "AvaTax Configuration",
+        required=True,
+        index=True,
+        ondelete="cascade",
+    )
+    hour = fields.Datetime(required=True, index=True)
+    operation = fields.Char(required=True)
+    call_count = fields.Integer("Calls")
+    error_count = fields.Integer("Errors")
+    cached_count = fields.Integer("Shared Results")
+    duration_avg = fields.Float("Average (ms)", group_operator="avg")
+    duration_p50 = fields.Float("Median (ms)", group_operator="max")
+    duration_p95 = fields.Float("95th Percentile (ms)", group_operator="max")
+    duration_p99 = fields.Float("99th Percentile (ms)", group_operator="max")
+    duration_max = fields.Float("Slowest (ms)", group_operator="max")
+    slowest_doc_code = fields.Char("Slowest Document")
+
+    _sql_constraints = [
+        (
+            "hour_uniq",
+            "unique (config_id, hour, operation)",
+            "Call statistics are unique per configuration, hour and operation!",
+        )
+    ]
+
+    @api.model
+    def _cron_rollup(self):
+        """
+        Aggregate the recorded calls of the complete hours not rolled up yet,
+        and purge the calls older than the retention period.
+        The last hours are aggregated again, to include the calls
+        recorded late by other workers.
+        """
+        flush_calls(self.pool)
+        cr = self.env.cr
+        cr.execute("SELECT MAX(hour) FROM avalara_salestax_call_stat")
+        last_hour = cr.fetchone()[0]
+        current_hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        date_from = current_hour - timedelta(hours=ROLLUP_TRAILING_HOURS)
+        if not last_hour:
+            date_from = "-infinity"
+        elif last_hour + timedelta(hours=1) < date_from:
+            date_from = last_hour + timedelta(hours=1)
+        where = (
+            "call_date >= %s "
+            "AND call_date < date_trunc('hour', NOW() AT TIME ZONE 'UTC')"
+        )
+        cr.execute(
+            """
+            INSERT INTO avalara_salestax_call_stat (
+                create_uid, create_date, write_uid, write_date,
+                config_id, hour, operation, call_count, error_count, cached_count,
+                duration_avg, duration_p50, duration_p95, duration_p99,
+                duration_max, slowest_doc_code
+            )
+            SELECT
+                %s, NOW() AT TIME ZONE 'UTC', %s, NOW() AT TIME ZONE 'UTC',
+                config_id, date_trunc('hour', call_date), operation,
+                COUNT(*),
+                COUNT(error_code),
+                COUNT(*) FILTER (WHERE cached),
+                AVG(duration) FILTER (WHERE NOT cached),
+                percentile_cont(0.5) WITHIN GROUP (ORDER BY duration)
+                    FILTER (WHERE NOT cached),
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY duration)
+                    FILTER (WHERE NOT cached),
+                percentile_cont(0.99) WITHIN GROUP (ORDER BY duration)
+                    FILTER (WHERE NOT cached),
+                MAX(duration),
+                (array_agg(doc_code ORDER BY duration DESC)
+                    FILTER (WHERE doc_code IS NOT NULL))[1]
+            FROM avalara_salestax_call
+            WHERE {where}
+            GROUP BY config_id, date_trunc('hour', call_date), operation
+            ON CONFLICT (config_id, hour, operation) DO UPDATE SET
+                write_date = EXCLUDED.write_date,
+                call_count = EXCLUDED.call_count,
+                error_count = EXCLUDED.error_count,
+                cached_count = EXCLUDED.cached_count,
+                duration_avg = EXCLUDED.duration_avg,
+                duration_p50 = EXCLUDED.duration_p50,
+                duration_p95 = EXCLUDED.duration_p95,
+                duration_p99 = EXCLUDED.duration_p99,
+                duration_max = EXCLUDED.duration_max,
+                slowest_doc_code = EXCLUDED.slowest_doc_code
+            """.format(
+                where=where
+            ),
+            [self.env.uid, self.env.uid, date_from],
+        )
+        cr.execute(
+            """
+            INSERT INTO avalara_salestax_call_error (
+                create_uid, create_date, write_uid, write_date,
+                config_id, hour, operation, error_code, error_count
+            )
+            SELECT
+                %s, NOW() AT TIME ZONE 'UTC', %s, NOW() AT TIME ZONE 'UTC',
+                config_id, date_trunc('hour', call_date), operation,
+                error_code, COUNT(*)
+            FROM avalara_salestax_call
+            WHERE {where} AND error_code IS NOT NULL
+            GROUP BY config_id, date_trunc('hour', call_date), operation, error_code
+            ON CONFLICT (config_id, hour, operation, error_code) DO UPDATE SET
+                write_date = EXCLUDED.write_date,
+                error_count = EXCLUDED.error_count
+            """.format(
+                where=where
+            ),
+            [self.env.uid, self.env.uid, date_from],
+        )
+        cr.execute(
+            "DELETE FROM avalara_salestax_call WHERE call_date < "
+            "(NOW() AT TIME ZONE 'UTC') - %s * INTERVAL '1 day'",
+            [CALL_RETENTION_DAYS],
+        )
+        self.invalidate_cache()
+        return True
+
+
+class AvalaraSalestaxCallError(models.Model):
+    """
+    Hourly rollup of the Avatax service errors, by Avalara message number
+    """
+
+    _name = "avalara.salestax.call.error"
+    _description = "AvaTax Hourly Error Statistics"
+    _order = "hour desc, error_count desc"
+
+    config_id = fields.Many2one(
+        "avalara.salestax",
+        "AvaTax Configuration",
+        required=True,
+        index=True,
+        ondelete="cascade",
+    )
+    hour = fields.Datetime(required=True, index=True)
+    operation = fields.Char(required=True)
+    error_code = fields.Char("Error Number")
+    error_count = fields.Integer("Errors")
+
+    _sql_constraints = [
+        (
+            "hour_uniq",
+            "unique (config_id, hour, operation, error_code)",
+            "Error statistics are unique per configuration, hour, "
+            "operation and error number!",
+        )
+    ]
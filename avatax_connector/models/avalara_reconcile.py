@@ -0,0 +1,316 @@
+import logging
+from itertools import islice
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+
+_logger = logging.getLogger(__name__)
+
+# Number of Avalara transactions inserted per SQL statement
+RECONCILE_CHUNK_SIZE = 1000
+
+
+class AvalaraSalestaxReconcile(models.Model):
+    """
+    Reconciliation run between posted Odoo invoices and Avalara transactions.
+
+    The Avalara transactions are streamed page by page into a temporary table,
+    and joined with the posted invoices by document code inside the database.
+    Only the discrepancies are stored, as reconciliation lines.
+    Listing a month of transactions takes a while: the runs are queued,
+    and done by a scheduled action.
+    """
+
+    _name = "avalara.salestax.reconcile"
+    _description = "AvaTax Reconciliation"
+    _order = "id desc"
+
+    name = fields.Char(compute="_compute_name")
+    avatax_config_id = fields.Many2one(
+        "avalara.salestax",
+        "AvaTax Configuration",
+        required=True,
+        ondelete="cascade",
+        default=lambda self: self.env.user.company_id.get_avatax_config_company(),
+    )
+    company_id = fields.Many2one(
+        related="avatax_config_id.company_id", store=True, readonly=True
+    )
+    date_from = fields.Date("From", required=True)
+    date_to = fields.Date("To", required=True)
+    state = fields.Selection(
+        [
+            ("draft", "Draft"),
+            ("queued", "Queued"),
+            ("running", "Running"),
+            ("done", "Done"),
+            ("failed", "Failed"),
+        ],
+        default="draft",
+        readonly=True,
+        copy=False,
+    )
+    date_start = fields.Datetime("Started On", readonly=True, copy=False)
+    date_reconcile = fields.Datetime("Reconciled On", readonly=True, copy=False)
+    transaction_count = fields.Integer(
+        "Avalara Transactions", readonly=True, copy=False
+    )
+    invoice_count = fields.Integer("Posted Invoices", readonly=True, copy=False)
+    line_ids = fields.One2many(
+        "avalara.salestax.reconcile.line",
+        "reconcile_id",
+        "Discrepancies",
+        readonly=True,
+        copy=False,
+    )
+    line_count = fields.Integer(compute="_compute_line_count")
+    error_message = fields.Text("Error", readonly=True, copy=False)
+
+    @api.depends("avatax_config_id", "date_from", "date_to")
+    def _compute_name(self):
+        for run in self:
+            run.name = "%s %s - %s" % (
+                run.avatax_config_id.company_code or "",
+                run.date_from or "",
+                run.date_to or "",
+            )
+
+    @api.depends("line_ids")
+    def _compute_line_count(self):
+        data = self.env["avalara.salestax.reconcile.line"].read_group(
+            [("reconcile_id", "in", self.ids)], ["reconcile_id"], ["reconcile_id"]
+        )
+        counts = {x["reconcile_id"][0]: x["reconcile_id_count"] for x in data}
+        for run in self:
+            run.line_count = counts.get(run.id, 0)
+
+    def _get_posted_invoices_query(self):
+        """
+        Returns the SQL query and parameters selecting the posted invoices
+        expected to have a committed Avalara transaction.
+        """
+        self.ensure_one()
+        query = """
+            SELECT inv.id, inv.number, inv.avatax_amount
+            FROM account_invoice inv
+            WHERE inv.company_id = %s
+              AND inv.type IN ('out_invoice', 'out_refund')
+              AND inv.state IN ('open', 'in_payment', 'paid')
+              AND inv.number IS NOT NULL
+              AND inv.date_invoice BETWEEN %s AND %s
+              AND EXISTS (
+                SELECT 1
+                FROM account_invoice_line line
+                JOIN account_invoice_line_tax line_tax
+                  ON line_tax.invoice_line_id = line.id
+                JOIN account_tax tax ON tax.id = line_tax.tax_id
+                WHERE line.invoice_id = inv.id AND tax.is_avatax
+              )
+        """
+        return query, [self.company_id.id, self.date_from, self.date_to]
+
+    def _load_avatax_transactions(self, transactions):
+        """
+        Stream the Avalara transactions into a temporary table,
+        in chunks, to keep memory usage constant.
+        Returns the number of transactions loaded.
+        """
+        cr = self.env.cr
+        cr.execute(
+            """
+            CREATE TEMPORARY TABLE IF NOT EXISTS avatax_reconcile_transaction (
+                code VARCHAR PRIMARY KEY,
+                status VARCHAR,
+                total_tax NUMERIC
+            ) ON COMMIT DROP
+            """
+        )
+        cr.execute("TRUNCATE avatax_reconcile_transaction")
+        count = 0
+        transactions = iter(transactions)
+        while True:
+            chunk = list(islice(transactions, RECONCILE_CHUNK_SIZE))
+            if not chunk:
+                break
+            params = []
+            for transaction in chunk:
+                params += [
+                    transaction.get("code"),
+                    transaction.get("status"),
+                    transaction.get("totalTax") or 0.0,
+                ]
+            cr.execute(
+                "INSERT INTO avatax_reconcile_transaction (code, status, total_tax) "
+                "VALUES " + ", ".join(["(%s, %s, %s)"] * len(chunk)) + " "
+                "ON CONFLICT (code) DO UPDATE "
+                "SET status = EXCLUDED.status, total_tax = EXCLUDED.total_tax",
+                params,
+            )
+            count += len(chunk)
+        return count
+
+    def _store_discrepancies(self):
+        """
+        Join posted invoices and Avalara transactions by document code,
+        and store the discrepancies found as reconciliation lines.
+        """
+        self.ensure_one()
+        invoice_query, params = self._get_posted_invoices_query()
+        self.env.cr.execute(
+            """
+            WITH invoice AS ({invoice_query}),
+            joined AS (
+                SELECT
+                    invoice.id AS invoice_id,
+                    COALESCE(invoice.number, trans.code) AS doc_code,
+                    invoice.avatax_amount AS odoo_amount,
+                    ABS(trans.total_tax) AS avatax_amount,
+                    trans.status AS avatax_status,
+                    CASE
+                        WHEN trans.code IS NULL THEN 'missing'
+                        WHEN invoice.id IS NULL THEN 'not_posted'
+                        WHEN trans.status = 'Cancelled' THEN 'voided'
+                        WHEN trans.status <> 'Committed' THEN 'uncommitted'
+                        WHEN ROUND(ABS(ABS(trans.total_tax)
+                            - COALESCE(invoice.avatax_amount, 0)), 2) >= 0.01
+                            THEN 'mismatch'
+                    END AS issue
+                FROM invoice
+                FULL OUTER JOIN avatax_reconcile_transaction trans
+                  ON trans.code = invoice.number
+                WHERE invoice.id IS NOT NULL OR trans.status <> 'Cancelled'
+            )
+            INSERT INTO avalara_salestax_reconcile_line (
+                create_uid, create_date, write_uid, write_date,
+                reconcile_id, invoice_id, doc_code,
+                odoo_amount, avatax_amount, avatax_status, issue
+            )
+            SELECT
+                %s, NOW() AT TIME ZONE 'UTC', %s, NOW() AT TIME ZONE 'UTC',
+                %s, invoice_id, doc_code,
+                odoo_amount, avatax_amount, avatax_status, issue
+            FROM joined
+            WHERE issue IS NOT NULL
+            """.format(
+                invoice_query=invoice_query
+            ),
+            params + [self.env.uid, self.env.uid, self.id],
+        )
+        self.env.cr.execute(
+            "SELECT COUNT(*) FROM ({}) invoice".format(invoice_query), params
+        )
+        return self.env.cr.fetchone()[0]
+
+    @api.multi
+    def action_reconcile(self):
+        """ Queue the reconciliations, done by a scheduled action """
+        for run in self:
+            avatax_config = run.avatax_config_id
+            if "rest" not in avatax_config.service_url:
+                raise UserError(
+                    _("Reconciliation is only supported with the REST API.")
+                )
+            if avatax_config.disable_tax_calculation:
+                raise UserError(_("Avatax tax calculation is disabled."))
+        self.write({"state": "queued", "error_message": False})
+        return True
+
+    def _reconcile(self):
+        """ List the Avalara transactions, and store the discrepancies found """
+        self.ensure_one()
+        avatax_config = self.avatax_config_id
+        avatax = avatax_config.with_context(avatax_batch=True).get_avatax_rest_service()
+        if not avatax:
+            raise UserError(_("Avatax tax calculation is disabled."))
+        self.line_ids.unlink()
+        transactions = avatax.list_transactions(
+            avatax_config.company_code, self.date_from, self.date_to
+        )
+        transaction_count = self._load_avatax_transactions(transactions)
+        invoice_count = self._store_discrepancies()
+        self.invalidate_cache()
+        self.write(
+            {
+                "state": "done",
+                "date_reconcile": fields.Datetime.now(),
+                "transaction_count": transaction_count,
+                "invoice_count": invoice_count,
+            }
+        )
+        _logger.info(
+            "Avatax reconciliation %s: %d transactions, %d invoices, "
+            "%d discrepancies",
+            self.name,
+            transaction_count,
+            invoice_count,
+            self.line_count,
+        )
+        return True
+
+    @api.model
+    def _cron_run_reconciliations(self):
+        """
+        Run the queued reconciliations, one transaction each.
+        The running state is committed first, to show the progress.
+        Runs left running were interrupted, and are run again:
+        the scheduled action never runs twice at the same time.
+        """
+        runs = self.search([("state", "in", ["queued", "running"])], order="id")
+        for run in runs:
+            run.write({"state": "running", "date_start": fields.Datetime.now()})
+            self.env.cr.commit()
+            try:
+                with self.env.cr.savepoint():
+                    run._reconcile()
+            except Exception as error:
+                _logger.warning(
+                    "Avatax reconciliation %s failed: %s", run.name, error
+                )
+                run.invalidate_cache()
+                run.write(
+                    {
+                        "state": "failed",
+                        "error_message": getattr(error, "name", None) or str(error),
+                    }
+                )
+            self.env.cr.commit()
+        return True
+
+    @api.multi
+    def action_view_lines(self):
+        self.ensure_one()
+        action = self.env.ref(
+            "avatax_connector.action_avalara_salestax_reconcile_line"
+        ).read()[0]
+        action["domain"] = [("reconcile_id", "=", self.id)]
+        return action
+
+
+class AvalaraSalestaxReconcileLine(models.Model):
+    _name = "avalara.salestax.reconcile.line"
+    _description = "AvaTax Reconciliation Discrepancy"
+    _order = "issue, doc_code"
+
+    reconcile_id = fields.Many2one(
+        "avalara.salestax.reconcile",
+        "Reconciliation",
+        required=True,
+        index=True,
+        ondelete="cascade",
+    )
+    invoice_id = fields.Many2one("account.invoice", "Invoice", ondelete="set null")
+    doc_code = fields.Char("Document Code")
+    issue = fields.Selection(
+        [
+            ("missing", "Missing in Avalara"),
+            ("uncommitted", "Not Committed in Avalara"),
+            ("voided", "Voided in Avalara"),
+            ("mismatch", "Tax Amount Mismatch"),
+            ("not_posted", "Not Posted in Odoo"),
+        ],
+        required=True,
+        index=True,
+    )
+    odoo_amount = fields.Float("Odoo Tax Amount")
+    avatax_amount = fields.Float("Avalara Tax Amount")
+    avatax_status = fields.Char("Avalara Status")
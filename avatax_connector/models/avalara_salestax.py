@@ -1,11 +1,42 @@
+import copy
+import functools
+import json
 import logging
-from odoo import api, fields, models, _
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from odoo import SUPERUSER_ID, api, fields, models, tools, _
 from odoo.exceptions import UserError, ValidationError
+from .avalara_api import AvaTaxService
+from .avalara_metrics import SERVICE_STATUS_WINDOW, record_call
 from .avatax_rest_api import AvaTaxRESTService
 
 
 _logger = logging.getLogger(__name__)
 
+# Maximum number of concurrent requests for bulk operations
+BULK_MAX_WORKERS = 8
+
+# Share of the request rate limit batch jobs leave for interactive users
+RATE_LIMIT_INTERACTIVE_RESERVE = 0.25
+
+# Seconds the connection warm-up waits for the AvaTax service,
+# so that an unavailable service does not hold a background thread
+WARM_UP_TIMEOUT = 10
+
+# Seconds a tax calculation result is shared with identical requests
+# waiting for it in other workers
+SINGLE_FLIGHT_TTL = 30
+
+# Seconds a calculation waits for an identical one running in another worker,
+# and seconds between its checks for the shared result
+SINGLE_FLIGHT_WAIT = 10
+SINGLE_FLIGHT_POLL = 0.1
+
+# Commit results of this process, by request fingerprint,
+# kept until their database transaction is committed
+COMMIT_RESULTS = {}
+
 
 class ExemptionCode(models.Model):
     _name = "exemption.code"
@@ -72,6 +103,41 @@ class AvalaraSalestax(models.Model):
         default=300,
         help="Defines AvaTax request time out length, AvaTax best practices prescribes default setting of 300 seconds",
     )
+    detail_level = fields.Selection(
+        [
+            ("Document", "Document"),
+            ("Line", "Line"),
+            ("Tax", "Tax"),
+            ("Diagnostic", "Diagnostic"),
+        ],
+        "Response Detail Level",
+        required=True,
+        default="Tax",
+        help="Level of detail of the tax calculation responses. "
+        "Tax gives the per line jurisdiction rates. "
+        "Line and Document give smaller responses; "
+        "with the REST API, tax rates are then derived from the line amounts. "
+        "Diagnostic is meant for development only.",
+    )
+    profiling = fields.Boolean(
+        "Profile Tax Computations",
+        help="Profile the document tax computations, and attach the profile "
+        "to the document. Slows down the computations: "
+        "only enable it to investigate performance issues.",
+    )
+    warm_up = fields.Boolean(
+        "Warm Up Connection",
+        help="Prepare the connection to the AvaTax service in background "
+        "when the Odoo workers start, "
+        "so that the first tax computation is not slowed down.",
+    )
+    rate_limit = fields.Integer(
+        "Max Requests per Second",
+        help="Maximum number of REST API requests per second, "
+        "shared by all the Odoo workers. "
+        "Batch jobs leave part of it to interactive users. "
+        "Zero means no limit.",
+    )
     company_code = fields.Char(
         "Company Code",
         required=True,
@@ -95,6 +161,12 @@ class AvalaraSalestax(models.Model):
         "Address Validation on save for customer profile",
         help="Validates the address and automatically saves when Customer profile is saved.",
     )
+    validation_deferred = fields.Boolean(
+        "Validate Addresses in Background",
+        help="When validating addresses on save, the customer profile is saved "
+        "right away, and the address is validated shortly after "
+        "by a scheduled action.",
+    )
     force_address_validation = fields.Boolean(
         "Force Address Validation",
         help="Check if address validation should be done before tax calculation",
@@ -122,6 +194,13 @@ class AvalaraSalestax(models.Model):
         help="Tax is computed immediately, as document lines are being added."
         " Warning: will cause heavy traffic on the Avatax service.",
     )
+    immediate_calculation_delay = fields.Integer(
+        "Immediate Calculation Delay",
+        help="Seconds to wait after the last line change before computing "
+        "the taxes in background, once for all the accumulated changes; "
+        "the new totals show when the document is reloaded. "
+        "Zero computes the taxes on every line change.",
+    )
     default_shipping_code_id = fields.Many2one(
         "product.tax.code",
         "Default Shipping Code",
@@ -161,6 +240,128 @@ class AvalaraSalestax(models.Model):
         help="Allows ean13 to be reported in place of Item Reference as upc identifier.",
     )
 
+    perf_call_count = fields.Integer(
+        "Calls (24h)", compute="_compute_performance"
+    )
+    perf_error_rate = fields.Float(
+        "Error Rate (24h, %)", compute="_compute_performance"
+    )
+    perf_duration_p95 = fields.Float(
+        "95th Percentile Latency (24h, ms)",
+        compute="_compute_performance",
+        help="Highest hourly 95th percentile of the tax calculations",
+    )
+    perf_cache_hit_rate = fields.Float(
+        "Shared Results (24h, %)",
+        compute="_compute_performance",
+        help="Share of the tax calculations answered with the result "
+        "of an identical calculation in progress",
+    )
+    perf_wait_count = fields.Integer(
+        "Throttled Requests", compute="_compute_performance"
+    )
+    perf_wait_time = fields.Float(
+        "Throttling Wait (s)", compute="_compute_performance"
+    )
+    service_status = fields.Selection(
+        [
+            ("unknown", "No Recent Calls"),
+            ("available", "Available"),
+            ("degraded", "Degraded"),
+            ("unavailable", "Unavailable"),
+        ],
+        compute="_compute_performance",
+        help="From the error rate of the calls of the last minutes",
+    )
+
+    @api.multi
+    def _compute_performance(self):
+        """
+        Read the hourly rollups of the last 24 hours,
+        and the individual calls of the last minutes for the service status.
+        """
+        ids = tuple(x for x in self.ids if isinstance(x, int)) or (0,)
+        cr = self.env.cr
+        cr.execute(
+            """
+            SELECT config_id, SUM(call_count), SUM(error_count),
+                MAX(duration_p95) FILTER (WHERE operation = 'CreateTransaction'),
+                SUM(call_count) FILTER (WHERE operation = 'CreateTransaction'),
+                SUM(cached_count) FILTER (WHERE operation = 'CreateTransaction')
+            FROM avalara_salestax_call_stat
+            WHERE config_id IN %s
+              AND hour >= (NOW() AT TIME ZONE 'UTC') - INTERVAL '24 hours'
+            GROUP BY config_id
+            """,
+            [ids],
+        )
+        stats = {x[0]: x[1:] for x in cr.fetchall()}
+        cr.execute(
+            """
+            SELECT config_id, COUNT(*), COUNT(error_code)
+            FROM avalara_salestax_call
+            WHERE config_id IN %s
+              AND call_date >= (NOW() AT TIME ZONE 'UTC') - %s * INTERVAL '1 minute'
+            GROUP BY config_id
+            """,
+            [ids, SERVICE_STATUS_WINDOW],
+        )
+        recent = {x[0]: x[1:] for x in cr.fetchall()}
+        cr.execute(
+            "SELECT config_id, wait_count, wait_time "
+            "FROM avalara_salestax_rate_bucket WHERE config_id IN %s",
+            [ids],
+        )
+        waits = {x[0]: x[1:] for x in cr.fetchall()}
+        for avatax_config in self:
+            calls, errors, p95, calculations, cached = stats.get(
+                avatax_config.id, (0, 0, 0.0, 0, 0)
+            )
+            avatax_config.perf_call_count = calls or 0
+            avatax_config.perf_error_rate = calls and errors * 100.0 / calls or 0.0
+            avatax_config.perf_duration_p95 = p95 or 0.0
+            avatax_config.perf_cache_hit_rate = (
+                calculations and (cached or 0) * 100.0 / calculations or 0.0
+            )
+            wait_count, wait_time = waits.get(avatax_config.id, (0, 0.0))
+            avatax_config.perf_wait_count = wait_count
+            avatax_config.perf_wait_time = wait_time
+            recent_calls, recent_errors = recent.get(avatax_config.id, (0, 0))
+            if not recent_calls:
+                status = "unknown"
+            elif recent_errors * 2 >= recent_calls:
+                status = "unavailable"
+            elif recent_errors * 10 >= recent_calls:
+                status = "degraded"
+            else:
+                status = "available"
+            avatax_config.service_status = status
+
+    @api.multi
+    def _get_performance_action(self, xml_id):
+        self.ensure_one()
+        action = self.env.ref(xml_id).read()[0]
+        action["domain"] = [("config_id", "=", self.id)]
+        return action
+
+    @api.multi
+    def action_view_call_stats(self):
+        return self._get_performance_action(
+            "avatax_connector.action_avalara_salestax_call_stat"
+        )
+
+    @api.multi
+    def action_view_call_errors(self):
+        return self._get_performance_action(
+            "avatax_connector.action_avalara_salestax_call_error"
+        )
+
+    @api.multi
+    def action_view_slowest_calls(self):
+        return self._get_performance_action(
+            "avatax_connector.action_avalara_salestax_call_slowest"
+        )
+
     @api.constrains("service_url", "on_line")
     def _check_tax_by_line(self):
         if "rest" in self.service_url and self.on_line:
@@ -182,20 +383,336 @@ class AvalaraSalestax(models.Model):
         ),
     ]
 
-    def get_avatax_rest_service(self):
+    @api.model_cr
+    def init(self):
+        self._cr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS avalara_salestax_flight (
+                fingerprint VARCHAR PRIMARY KEY,
+                result TEXT,
+                create_date TIMESTAMP DEFAULT (NOW() AT TIME ZONE 'UTC')
+            )
+            """
+        )
+        self._cr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS avalara_salestax_rate_bucket (
+                config_id INTEGER PRIMARY KEY,
+                tokens DOUBLE PRECISION NOT NULL,
+                updated TIMESTAMP NOT NULL,
+                request_count BIGINT NOT NULL DEFAULT 0,
+                wait_count BIGINT NOT NULL DEFAULT 0,
+                wait_time DOUBLE PRECISION NOT NULL DEFAULT 0
+            )
+            """
+        )
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.clear_caches()
+        configs = super().create(vals_list)
+        configs._avatax_update_dirty_crons()
+        return configs
+
+    @api.multi
+    def write(self, vals):
+        if {"profiling", "company_id", "disable_tax_calculation"} & set(vals):
+            self.clear_caches()
+        res = super().write(vals)
+        if {
+            "enable_immediate_calculation",
+            "immediate_calculation_delay",
+            "disable_tax_calculation",
+        } & set(vals):
+            self._avatax_update_dirty_crons()
+        return res
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        res = super().unlink()
+        self._avatax_update_dirty_crons()
+        return res
+
+    @api.model
+    def _avatax_update_dirty_crons(self):
+        """
+        The background computation of the changed documents only runs
+        while a configuration has a debounced immediate calculation.
+        """
+        active = any(
+            x._is_calculation_debounced()
+            for x in self.sudo().search([("disable_tax_calculation", "=", False)])
+        )
+        for xmlid in (
+            "avatax_connector.ir_cron_compute_dirty_invoice_taxes",
+            "avatax_connector.ir_cron_compute_dirty_order_taxes",
+        ):
+            cron = self.env.ref(xmlid, raise_if_not_found=False)
+            if cron and cron.active != active:
+                cron.sudo().active = active
+
+    @api.model
+    @tools.ormcache()
+    def _get_profiling_company_ids(self):
+        """
+        Returns the ids of the companies profiling their tax computations.
+        Kept in the registry cache, to avoid a search on every computation.
+        """
+        configs = self.sudo().search(
+            [("profiling", "=", True), ("disable_tax_calculation", "=", False)]
+        )
+        return frozenset(configs.mapped("company_id").ids)
+
+    def _avatax_throttle(self):
+        """
+        Token bucket limiting the REST API requests per second,
+        shared by all the workers through a database row.
+        Interactive requests can use all the tokens, and batch requests
+        (avatax_batch context key) leave a reserve for them.
+        Blocks until a token is available. Returns the seconds waited.
+        """
+        rate = self.rate_limit
+        if not rate:
+            return 0.0
+        reserve = 0.0
+        if self.env.context.get("avatax_batch"):
+            # The bucket holds at most rate tokens: a batch request
+            # must still be able to get one
+            reserve = max(min(rate * RATE_LIMIT_INTERACTIVE_RESERVE, rate - 1), 0.0)
+        waited = 0.0
+        while True:
+            with self.pool.cursor() as cr:
+                cr.execute(
+                    "INSERT INTO avalara_salestax_rate_bucket "
+                    "(config_id, tokens, updated) VALUES (%s, %s, clock_timestamp()) "
+                    "ON CONFLICT (config_id) DO NOTHING",
+                    [self.id, rate],
+                )
+                cr.execute(
+                    "SELECT tokens, EXTRACT(EPOCH FROM clock_timestamp() - updated) "
+                    "FROM avalara_salestax_rate_bucket "
+                    "WHERE config_id = %s FOR UPDATE",
+                    [self.id],
+                )
+                tokens, elapsed = cr.fetchone()
+                tokens = min(rate, tokens + max(elapsed, 0.0) * rate)
+                wait = 0.0
+                if tokens >= 1 + reserve:
+                    tokens -= 1
+                else:
+                    wait = (1 + reserve - tokens) / rate
+                cr.execute(
+                    "UPDATE avalara_salestax_rate_bucket "
+                    "SET tokens = %s, updated = clock_timestamp(), "
+                    "request_count = request_count + %s, "
+                    "wait_count = wait_count + %s, wait_time = wait_time + %s "
+                    "WHERE config_id = %s",
+                    [
+                        tokens,
+                        0 if wait else 1,
+                        1 if not wait and waited else 0,
+                        0.0 if wait else waited,
+                        self.id,
+                    ],
+                )
+            if not wait:
+                break
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            _logger.info(
+                "Avatax request throttled for %.2f seconds (config %s%s)",
+                waited,
+                self.id,
+                ", batch" if reserve else "",
+            )
+        return waited
+
+    def _avatax_get_flight_result(self, key):
+        """ Returns the stored result of a recent identical calculation """
+        with self.pool.cursor() as cr:
+            cr.execute(
+                "SELECT result FROM avalara_salestax_flight "
+                "WHERE fingerprint = %s AND create_date >= "
+                "(NOW() AT TIME ZONE 'UTC') - %s * INTERVAL '1 second'",
+                [key, SINGLE_FLIGHT_TTL],
+            )
+            row = cr.fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _avatax_store_flight_result(self, key, result):
+        """ Stores a calculation result, for the identical calculations """
+        with self.pool.cursor() as cr:
+            cr.execute(
+                "DELETE FROM avalara_salestax_flight WHERE create_date < "
+                "(NOW() AT TIME ZONE 'UTC') - %s * INTERVAL '1 second'",
+                [SINGLE_FLIGHT_TTL],
+            )
+            cr.execute(
+                "INSERT INTO avalara_salestax_flight (fingerprint, result) "
+                "VALUES (%s, %s) ON CONFLICT (fingerprint) DO UPDATE "
+                "SET result = EXCLUDED.result, "
+                "create_date = NOW() AT TIME ZONE 'UTC'",
+                [key, json.dumps(result)],
+            )
+
+    def _avatax_shared_flight(self, key, func):
+        """
+        Coalesces identical tax calculations running in different workers.
+        The leader holds a session advisory lock for the key, on the current
+        cursor, while calling Avatax, and then stores the result.
+        The followers poll for the stored result, for a limited time,
+        and then call Avatax themselves.
+        A transaction retried after a serialization failure also reuses it.
+        The stored results are read and written with short transactions:
+        no other cursor is held during the call.
+        """
+        lock_key = int(key[:15], 16)
+        cr = self.env.cr
+        deadline = time.time() + SINGLE_FLIGHT_WAIT
+        while True:
+            result = self._avatax_get_flight_result(key)
+            if result is not None:
+                _logger.debug("Sharing stored Avatax result %s", key)
+                return result
+            cr.execute("SELECT pg_try_advisory_lock(%s)", [lock_key])
+            if cr.fetchone()[0]:
+                break
+            if time.time() >= deadline:
+                _logger.info("Avatax result %s not shared in time", key)
+                return func()
+            time.sleep(SINGLE_FLIGHT_POLL)
+        try:
+            # Stored by a leader between the check and the lock
+            result = self._avatax_get_flight_result(key)
+            if result is None:
+                result = func()
+                self._avatax_store_flight_result(key, result)
+            return result
+        finally:
+            cr.execute("SELECT pg_advisory_unlock(%s)", [lock_key])
+
+    def _avatax_commit_once(self, key, func):
+        """
+        Sends a commit request once per database transaction: the result
+        is kept in this process until the current transaction is committed,
+        so that when it is retried after a serialization failure,
+        the same commit is not sent again to Avatax.
+        """
+        now = time.time()
+        for memo_key in [
+            x for x, (date, result) in list(COMMIT_RESULTS.items())
+            if now - date > SINGLE_FLIGHT_TTL
+        ]:
+            COMMIT_RESULTS.pop(memo_key, None)
+        memo_key = (self.env.cr.dbname, key)
+        memo = COMMIT_RESULTS.get(memo_key)
+        if memo:
+            _logger.info("Reusing the Avatax commit result of a retried transaction")
+            return copy.deepcopy(memo[1])
+        result = func()
+        COMMIT_RESULTS[memo_key] = (now, copy.deepcopy(result))
+        self.env.cr.after("commit", lambda: COMMIT_RESULTS.pop(memo_key, None))
+        return result
+
+    def _register_hook(self):
+        super()._register_hook()
+        try:
+            with self.env.cr.savepoint():
+                configs = self.sudo().search(
+                    [("warm_up", "=", True), ("disable_tax_calculation", "=", False)]
+                )
+        except Exception as error:
+            _logger.warning("Avatax connection warm-up skipped: %s", error)
+            return
+        if not configs or getattr(threading.current_thread(), "testing", False):
+            return
+        # Contacting the service must not delay the registry loading
+        threading.Thread(
+            target=self._avatax_warm_up_thread,
+            args=(configs.ids,),
+            name="avatax.warm_up",
+            daemon=True,
+        ).start()
+
+    def _avatax_warm_up_thread(self, config_ids):
+        """ Warm up the connections in background, with its own cursor """
+        try:
+            with api.Environment.manage(), self.pool.cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                env[self._name].browse(config_ids)._avatax_warm_up()
+        except Exception as error:
+            _logger.warning("Avatax connection warm-up failed: %s", error)
+
+    def _avatax_warm_up(self):
+        """
+        Prepare the AvaTax service connections, so that the first
+        tax computation does not pay for it.
+        With SOAP, the WSDL parsing is kept for the whole process.
+        Failures are only logged.
+        """
+        for avatax_config in self:
+            start = time.time()
+            try:
+                if "rest" in avatax_config.service_url:
+                    avatax_config.get_avatax_rest_service(
+                        timeout=WARM_UP_TIMEOUT
+                    ).ping()
+                else:
+                    AvaTaxService(
+                        avatax_config.account_number,
+                        avatax_config.license_key,
+                        avatax_config.service_url,
+                        WARM_UP_TIMEOUT,
+                        avatax_config.logging,
+                    ).create_tax_service().create_address_service().ping()
+            except Exception as error:
+                _logger.warning(
+                    "Avatax connection warm-up failed for %s: %s",
+                    avatax_config.company_code,
+                    error,
+                )
+                continue
+            _logger.info(
+                "Avatax connection warmed up for %s in %.2f seconds",
+                avatax_config.company_code,
+                time.time() - start,
+            )
+        return True
+
+    def _is_calculation_debounced(self):
+        """ Immediate calculation is done in background, after a delay """
+        return bool(
+            self
+            and self.enable_immediate_calculation
+            and self.immediate_calculation_delay > 0
+        )
+
+    def get_avatax_rest_service(self, timeout=None):
         self.ensure_one()
         if self.disable_tax_calculation:
             _logger.info(
                 "Avatax tax calculation is disabled, skipping Avatax API contact."
             )
             return False
-        return AvaTaxRESTService(
+        service = AvaTaxRESTService(
             self.account_number,
             self.license_key,
             self.service_url,
             self.request_timeout,
             self.logging,
+            scope=self.env.cr.dbname,
+            shared_flight=self._avatax_shared_flight,
+            commit_once=self._avatax_commit_once,
+            throttle=self._avatax_throttle if self.rate_limit else None,
+            detail_level=self.detail_level,
+            metrics=functools.partial(record_call, self),
         )
+        if timeout:
+            # Request timeout of the Avalara SDK, 10 seconds when not set
+            service.client.timeout_limit = timeout
+        return service
 
     def create_transaction(
         self,
@@ -217,8 +734,17 @@ class AvalaraSalestax(models.Model):
         currency_id=None,
         ignore_error=None,
     ):
+        """
+        Computes, and optionally commits, the taxes of a document.
+        ship_from_address is the partner address, or preferably
+        the ship from values from res.company.get_avatax_origin().
+        """
         self.ensure_one()
         avatax_config = self
+        if not isinstance(ship_from_address, (dict, type(None))):
+            ship_from_address = self.env["res.company"]._get_avatax_origin_payload(
+                ship_from_address
+            )
 
         currency_code = self.env.user.company_id.currency_id.name
         if currency_id:
@@ -259,7 +785,7 @@ class AvalaraSalestax(models.Model):
                     )
 
             # if not avatax_config.address_validation:
-            if not ship_from_address.date_validation:
+            if not ship_from_address["validated"]:
                 raise UserError(_("Please validate your Company main address."))
 
         if avatax_config.disable_tax_calculation:
@@ -283,7 +809,7 @@ class AvalaraSalestax(models.Model):
             doc_type,
             partner.customer_code,
             doc_code,
-            ship_from_address,
+            ship_from_address["address"],
             shipping_address,
             lines,
             exemption_number,
@@ -316,6 +842,42 @@ class AvalaraSalestax(models.Model):
         )
         return result
 
+    def void_transactions(self, doc_codes):
+        """
+        Void several transactions concurrently, reusing a single REST client.
+        A failure voiding a document does not interrupt the others.
+        Returns a dict mapping each document code to the error message,
+        or to None if it was successfully voided.
+        """
+        self.ensure_one()
+        avatax = self.get_avatax_rest_service()
+        company_code = self.company_code
+
+        def void(doc_code):
+            try:
+                avatax.call(
+                    "void_transaction", company_code, doc_code, {"code": "DocVoided"}
+                )
+            except UserError as error:
+                return doc_code, error.name
+            except Exception as error:
+                return doc_code, str(error)
+            return doc_code, None
+
+        doc_codes = list(doc_codes)
+        if not doc_codes:
+            return {}
+        workers = min(BULK_MAX_WORKERS, len(doc_codes))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            result = dict(executor.map(void, doc_codes))
+        _logger.info(
+            "Avatax voided %d of %d documents for company %s",
+            len([x for x in result.values() if not x]),
+            len(result),
+            company_code,
+        )
+        return result
+
     def unvoid_transaction(self, doc_code, doc_type):
         self.ensure_one()
         avatax = self.get_avatax_rest_service()
@@ -0,0 +1,37 @@
+import zlib
+
+from odoo import _
+from odoo.exceptions import UserError
+
+
+def try_lock_documents(records):
+    """ Lock documents for their Avatax calculation, without waiting.
+        The locks are held until the end of the current transaction,
+        and a transaction can lock the same document again.
+        Returns the records locked by another transaction.
+    """
+    ids = [x for x in records.ids if isinstance(x, int)]
+    if not ids:
+        return records.browse()
+    namespace = zlib.crc32(records._name.encode("utf-8")) & 0x7FFFFFFF
+    records.env.cr.execute(
+        "SELECT id FROM unnest(%s) id WHERE NOT pg_try_advisory_xact_lock(%s, id)",
+        [ids, namespace],
+    )
+    return records.browse([x[0] for x in records.env.cr.fetchall()])
+
+
+def lock_documents(records):
+    """ Lock documents for their Avatax calculation,
+        or tell that it is already in progress.
+    """
+    busy = try_lock_documents(records)
+    if busy:
+        raise UserError(
+            _(
+                "AvaTax: the taxes of %s are being calculated in another session. "
+                "Please try again in a moment."
+            )
+            % ", ".join(busy.mapped("display_name"))
+        )
+    return True
@@ -0,0 +1,103 @@
+import base64
+import cProfile
+import functools
+import io
+import logging
+import marshal
+import pstats
+import threading
+import time
+
+from odoo import fields
+
+
+_logger = logging.getLogger(__name__)
+
+# Profiled functions accounted as time waiting for the Avatax service,
+# or for the database, as (file name ending, function name)
+NETWORK_FUNCTIONS = [
+    ("requests/sessions.py", "send"),  # REST API
+    ("suds/transport/http.py", "send"),  # SOAP API
+]
+SQL_FUNCTIONS = [("odoo/sql_db.py", "execute")]
+
+# Only the outermost profiled call of a thread is profiled
+_profiling = threading.local()
+
+
+def _cumulative_time(stats, functions):
+    return sum(
+        stat[3]
+        for (filename, lineno, funcname), stat in stats.stats.items()
+        if any(
+            filename.replace("\\", "/").endswith(name_end) and funcname == name
+            for name_end, name in functions
+        )
+    )
+
+
+def avatax_profiled(method):
+    """ Profile a document method computing Avatax taxes, when enabled
+        for the Avatax configuration or by the avatax_profile context key.
+
+        The profile is attached to the (first) document, in the pstats format,
+        and the attachment description splits the time spent waiting
+        for the Avatax service, for the database, and in local computations.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if getattr(_profiling, "active", False) or not self._avatax_is_profiling():
+            return method(self, *args, **kwargs)
+        _profiling.active = True
+        profile = cProfile.Profile()
+        start = time.time()
+        try:
+            profile.enable()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                profile.disable()
+                duration = time.time() - start
+                _store_profile(self, method.__name__, profile, duration)
+        finally:
+            _profiling.active = False
+
+    return wrapper
+
+
+def _store_profile(records, method_name, profile, duration):
+    stats = pstats.Stats(profile, stream=io.StringIO())
+    network = _cumulative_time(stats, NETWORK_FUNCTIONS)
+    sql = _cumulative_time(stats, SQL_FUNCTIONS)
+    summary = (
+        "%s on %s %s\n"
+        "Total: %.3f s, Avatax service: %.3f s, SQL: %.3f s, Local: %.3f s"
+        % (
+            method_name,
+            records._name,
+            records.ids,
+            duration,
+            network,
+            sql,
+            max(duration - network - sql, 0.0),
+        )
+    )
+    _logger.info("Avatax profile: %s", summary)
+    record = records[:1]
+    if not isinstance(record.id, int):
+        return  # Onchange on a new record: nothing to attach to
+    name = "avatax_%s_%s.prof" % (
+        method_name.strip("_"),
+        fields.Datetime.now().strftime("%Y%m%d%H%M%S"),
+    )
+    record.env["ir.attachment"].sudo().create(
+        {
+            "name": name,
+            "datas_fname": name,
+            "datas": base64.b64encode(marshal.dumps(stats.stats)),
+            "description": summary,
+            "res_model": record._name,
+            "res_id": record.id,
+        }
+    )
@@ -1,7 +1,12 @@
 # Copyright (C) 2020 Open Source Integrators
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 import collections
+import copy
+import hashlib
+import json
 import socket
+import threading
+import time
 
 try:
     from avalara import AvataxClient
@@ -13,15 +18,88 @@ from requests import status_codes
 
 from odoo import fields, tools, _
 from odoo.exceptions import UserError
+from .avatax_result import AvaTaxResult
 
 
 _logger = logging.getLogger(__name__)
 
+# CreateTransaction $include option for each response detail level
+DETAIL_LEVEL_INCLUDE = {
+    "Document": "Lines",
+    "Line": "Lines",
+    "Tax": "Lines,Details",
+    "Diagnostic": None,  # Everything
+}
+
+# Tax calculations in progress in this process, by request fingerprint
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def single_flight(key, func, shared_flight=None):
+    """ Runs func() once for concurrent calls with the same key.
+        The first caller (the leader) runs it, and the other callers
+        wait for it and get a copy of its result.
+        If the leader fails, the followers run func() themselves.
+        shared_flight(key, func) optionally extends this to other processes.
+    """
+    with _in_flight_lock:
+        flight = _in_flight.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = _in_flight[key] = {"done": threading.Event(), "result": None}
+    if not is_leader:
+        flight["done"].wait()
+        if flight["result"] is not None:
+            _logger.debug("Sharing in-flight Avatax result %s", key)
+            return copy.deepcopy(flight["result"])
+        return func()
+    try:
+        result = shared_flight(key, func) if shared_flight else func()
+        flight["result"] = copy.deepcopy(result)
+        return result
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+        flight["done"].set()
+
+
+def get_address_payload(address):
+    """ Returns the REST request payload of a partner address """
+    return {
+        "city": address.city,
+        "country": address.country_id.code or None,
+        "line1": address.street or None,
+        "postalCode": address.zip,
+        "region": address.state_id.code or None,
+    }
+
 
 class AvaTaxRESTService:
-    def __init__(self, username, password, url, timeout=300, enable_log=False):
+    def __init__(
+        self,
+        username,
+        password,
+        url,
+        timeout=300,
+        enable_log=False,
+        shared_flight=None,
+        throttle=None,
+        detail_level="Diagnostic",
+        metrics=None,
+        commit_once=None,
+        scope=None,
+    ):
         self.timeout = timeout
+        # Identifies the tenant in the request fingerprints,
+        # as a process can serve several databases and accounts
+        self.scope = [scope, username, url]
         self.is_log_enabled = enable_log
+        self.detail_level = detail_level
+        self.shared_flight = shared_flight
+        self.throttle = throttle
+        self.metrics = metrics
+        self.commit_once = commit_once
         # Set elements adapter defaults
         self.appname = "Odoo 12, by Open Source Integrators"
         self.version = "a0o0b0000058pOuAAI"
@@ -53,8 +131,64 @@ class AvaTaxRESTService:
         )
         return res
 
+    def _throttle(self):
+        """ Waits for the shared request rate limit, if any """
+        if self.throttle:
+            self.throttle()
+
+    def _send(self, operation, request, doc_code=None, ignore_error=None, parse=True):
+        """ Sends a request within the rate limit, and returns its result.
+            The duration and the Avalara error number, if any, are passed
+            to the metrics callback.
+        """
+        self._throttle()
+        start = time.time()
+        response = None
+        error_code = None
+        try:
+            response = request()
+            if not parse:
+                return response.json()
+            return self.get_result(response, ignore_error=ignore_error)
+        except UserError:
+            error_code = self._get_error_code(response)
+            raise
+        except Exception as error:
+            error_code = error.__class__.__name__
+            raise
+        finally:
+            if self.metrics:
+                self.metrics(
+                    operation,
+                    time.time() - start,
+                    doc_code=doc_code,
+                    error_code=error_code,
+                )
+
+    def _get_error_code(self, response):
+        """ Returns the Avalara message number of an error response """
+        if response is None:
+            return "Error"
+        try:
+            result = response.json() if response.text else {}
+        except ValueError:
+            result = {}
+        messages = result.get("messages") or result.get("error", {}).get("details")
+        errors = [
+            x for x in messages or [] if x.get("severity") in ("Error", "Exception")
+        ]
+        error = errors and errors[0] or {}
+        return str(error.get("number") or error.get("code") or response.status_code)
+
     def get_result(self, response, ignore_error=None):
         # To call from validate address and from compute tax
+        if response.status_code == 429:
+            raise UserError(
+                _(
+                    "AvaTax: the request rate allowed by Avalara was exceeded. "
+                    "Please try again in a moment."
+                )
+            )
         if not response.text:
             raise UserError(
                 _("No response message found.\n%s %s.") % (
@@ -126,8 +260,7 @@ class AvaTaxRESTService:
         return result
 
     def ping(self):
-        response = self.client.ping()
-        res = response.json()
+        res = self._send("Ping", self.client.ping, parse=False)
         if self.is_log_enabled:
             _logger.info(pprint.pformat(res, indent=1))
         if not res.get("authenticated"):
@@ -143,8 +276,9 @@ class AvaTaxRESTService:
             "country": country_code,
             "postalCode": address.get("zip"),
         }
-        response_partner = self.client.resolve_address(partner_data)
-        partner_dict = self.get_result(response_partner)
+        partner_dict = self._send(
+            "ResolveAddress", lambda: self.client.resolve_address(partner_data)
+        )
         addresses_dict = partner_dict.get("validatedAddresses")[0]
         BaseAddress = collections.namedtuple(
             "BaseAddress",
@@ -198,8 +332,11 @@ class AvaTaxRESTService:
             if user not specify in the own company
             return information about how the tax was calculated.  Intended
             for use only while the SDK is in a development environment.
+            @origin : the ship from partner address, or its payload
         """
-        if not origin.street:
+        if not isinstance(origin, dict):
+            origin = get_address_payload(origin)
+        if not origin["line1"]:
             raise UserError(
                 _(
                     "Please set the Company Address in the partner information and validate.  "
@@ -233,20 +370,8 @@ class AvaTaxRESTService:
                 #                     'postalCode': origin.zip,
                 #                     'region': origin.state_id.code or None
                 #                     }
-                "shipFrom": {
-                    "city": origin.city,
-                    "country": origin.country_id.code or None,
-                    "line1": origin.street or None,
-                    "postalCode": origin.zip,
-                    "region": origin.state_id.code or None,
-                },
-                "shipTo": {
-                    "city": destination.city,
-                    "country": destination.country_id.code or None,
-                    "line1": destination.street or None,
-                    "postalCode": destination.zip,
-                    "region": destination.state_id.code or None,
-                },
+                "shipFrom": origin,
+                "shipTo": get_address_payload(destination),
             },
             "lines": lineslist,
             # 'purchaseOrderNo": "2020-02-05-001"
@@ -284,16 +409,98 @@ class AvaTaxRESTService:
                 pprint.pformat(tax_document, indent=1),
             )
 
-        response = self.client.create_transaction(tax_document)
-        result = self.get_result(response, ignore_error=ignore_error)
-        # Enrich Avatax result with Odoo tax computation
-        for line in result.get("lines", []):
-            line["rate"] = (
-                round(sum(x["rate"] for x in line["details"]) * 100, 4)
-                if line.get("tax")
-                else 0.0
+        include = DETAIL_LEVEL_INCLUDE.get(self.detail_level)
+        params = include and {"$include": include} or None
+
+        calls = []
+
+        def create_transaction():
+            calls.append(True)
+            result = self._send(
+                "CreateTransaction",
+                lambda: self.client.create_transaction(tax_document, params),
+                doc_code=doc_code,
+                ignore_error=ignore_error,
             )
-        return result
+            # Enrich Avatax result with Odoo tax computation
+            for line in result.get("lines", []):
+                line["rate"] = self._get_line_rate(line)
+            return result
+
+        key = hashlib.sha1(
+            json.dumps(
+                [self.scope, tax_document, params], sort_keys=True, default=str
+            ).encode("utf-8")
+        ).hexdigest()
+        if commit:
+            if self.commit_once:
+                result = self.commit_once(key, create_transaction)
+            else:
+                result = create_transaction()
+        else:
+            # Identical concurrent calculations are sent only once
+            start = time.time()
+            result = single_flight(key, create_transaction, self.shared_flight)
+            if not calls and self.metrics:
+                # Result shared from an identical calculation
+                self.metrics(
+                    "CreateTransaction",
+                    time.time() - start,
+                    doc_code=doc_code,
+                    cached=True,
+                )
+        if ignore_error and result.get("number") == ignore_error:
+            return result  # The ignored error message
+        return AvaTaxResult.from_rest(result)
+
+    def _get_line_rate(self, line):
+        """ Returns the tax rate percentage of a result line.
+            Without the jurisdiction details (detail level lower than Tax),
+            it is derived from the line tax and taxable amounts,
+            and small amounts may give an approximate rate.
+        """
+        if not line.get("tax"):
+            return 0.0
+        if line.get("details"):
+            return round(sum(x["rate"] for x in line["details"]) * 100, 4)
+        taxable = line.get("taxableAmount")
+        return round(line["tax"] / taxable * 100, 4) if taxable else 0.0
+
+    def list_transactions(
+        self, company_code, date_from, date_to, page_size=1000, include=None
+    ):
+        """ Generator over the transactions of a company for a date range.
+            The Avalara listing is paged, and only one page is kept in memory,
+            so that month-end volumes can be iterated in constant memory.
+        """
+        if date_from and type(date_from) != str:
+            date_from = fields.Date.to_string(date_from)
+        if date_to and type(date_to) != str:
+            date_to = fields.Date.to_string(date_to)
+        params = {
+            "$filter": "date between '%s' and '%s'" % (date_from, date_to),
+            "$orderBy": "id ASC",
+            "$top": page_size,
+        }
+        if include:
+            params["$include"] = include
+        company_code = self._sanitize_text(company_code)
+        skip = 0
+        while True:
+            params["$skip"] = skip
+            if self.is_log_enabled:
+                _logger.info(
+                    "Request ListTransactionsByCompany %s %s", company_code, params
+                )
+            page = self._send(
+                "ListTransactions",
+                lambda: self.client.list_transactions_by_company(company_code, params),
+            ).get("value", [])
+            for transaction in page:
+                yield transaction
+            if len(page) < page_size:
+                break
+            skip += page_size
 
     def call(self, endpoint, company_code, doc_code, model=None, params=None):
         if self.is_log_enabled:
@@ -309,11 +516,12 @@ class AvaTaxRESTService:
         doc_code = self._sanitize_text(doc_code)
         endpoint_method = getattr(self.client, endpoint)
         if params:
-            response = endpoint_method(company_code, doc_code, model, params)
+            args = (company_code, doc_code, model, params)
         else:
-            response = endpoint_method(company_code, doc_code, model)
-        result = self.get_result(response)
-        return result
+            args = (company_code, doc_code, model)
+        return self._send(
+            endpoint, lambda: endpoint_method(*args), doc_code=doc_code
+        )
 
     # FIXME: deprecated
     def cancel_tax(self, company_code, doc_code, doc_type, cancel_code):
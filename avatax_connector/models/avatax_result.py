@@ -0,0 +1,76 @@
+from array import array
+
+
+class AvaTaxResult:
+    """ Compact tax calculation result.
+
+        Keeps only what the connector uses from the Avalara responses:
+        the document total tax, and per line arrays of taxes, rates
+        and taxable amounts, indexed by the Odoo line id.
+        Built once per calculation, from the REST or the SOAP response.
+    """
+
+    __slots__ = ("total_tax", "line_ids", "taxes", "rates", "taxables", "_index")
+
+    def __init__(self, total_tax=0.0, line_ids=(), taxes=(), rates=(), taxables=()):
+        self.total_tax = total_tax or 0.0
+        line_ids = list(line_ids)
+        if all(isinstance(x, int) for x in line_ids):
+            self.line_ids = array("q", line_ids)
+        else:
+            # Lines not saved yet, such as in onchanges, have NewId ids
+            self.line_ids = tuple(line_ids)
+        self.taxes = array("d", taxes)
+        self.rates = array("d", rates)
+        self.taxables = array("d", taxables)
+        self._index = {line_id: i for i, line_id in enumerate(self.line_ids)}
+
+    @classmethod
+    def from_rest(cls, result):
+        """ Build from a REST CreateTransaction response,
+            where the line numbers are the Odoo line ids,
+            and the lines were enriched with their rate.
+        """
+        lines = result.get("lines") or []
+        return cls(
+            result.get("totalTax"),
+            [int(x["lineNumber"]) for x in lines],
+            [x.get("tax") or 0.0 for x in lines],
+            [x.get("rate") or 0.0 for x in lines],
+            [x.get("taxableAmount") or 0.0 for x in lines],
+        )
+
+    @classmethod
+    def from_soap(cls, result, received_lines):
+        """ Build from a SOAP GetTaxResult.
+            The line numbers are positions in the request lines.
+            Documents requested with the Document detail level have no lines.
+        """
+        tax_lines = getattr(result, "TaxLines", None)
+        tax_lines = tax_lines and getattr(tax_lines, "TaxLine", None) or []
+        lines = [(received_lines[int(x.No)]["id"].id, x) for x in tax_lines]
+        return cls(
+            float(result.TotalTax or 0.0),
+            [line_id for line_id, x in lines],
+            [float(x.Tax or 0.0) for line_id, x in lines],
+            [round(float(x.Rate or 0.0) * 100, 4) for line_id, x in lines],
+            [float(x.Taxable or 0.0) for line_id, x in lines],
+        )
+
+    def __len__(self):
+        return len(self.line_ids)
+
+    def __contains__(self, line_id):
+        return line_id in self._index
+
+    def __iter__(self):
+        """ Iterate over (line id, tax, rate) tuples """
+        return zip(self.line_ids, self.taxes, self.rates)
+
+    def get_tax(self, line_id, default=0.0):
+        i = self._index.get(line_id)
+        return default if i is None else self.taxes[i]
+
+    def get_rate(self, line_id, default=0.0):
+        i = self._index.get(line_id)
+        return default if i is None else self.rates[i]
@@ -1,16 +1,146 @@
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from random import random
 import time
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError
-from odoo.tools import DEFAULT_SERVER_DATE_FORMAT
+from odoo.tools import DEFAULT_SERVER_DATE_FORMAT, create_index
 from odoo.addons.base.models.res_partner import ADDRESS_FIELDS
 from .avalara_api import AvaTaxService, BaseAddress
-from .avatax_rest_api import AvaTaxRESTService
+from .avalara_salestax import BULK_MAX_WORKERS
 
 
 _LOGGER = logging.getLogger(__name__)
 
+# Partner fields in the cached ship from values
+ORIGIN_FIELDS = set(ADDRESS_FIELDS) | {"date_validation"}
+
+# Partner fields affecting the exemption index
+EXEMPTION_INDEX_FIELDS = {
+    "property_tax_exempt",
+    "property_exemption_number",
+    "property_exemption_code_id",
+    "country_id",
+    "state_id",
+    "parent_id",
+    "is_company",
+    "active",
+}
+
+
+class ResPartnerExemption(models.Model):
+    """
+    Index of the exemptions available for a commercial partner.
+
+    There is one record per exempt address and company,
+    so that finding the exemption for a document is a single indexed read,
+    instead of scanning all the commercial partner addresses.
+    It is maintained by the res.partner create and write methods.
+    """
+
+    _name = "res.partner.exemption"
+    _description = "Partner Exemption Index"
+    _order = "sequence, id"
+
+    partner_id = fields.Many2one(
+        "res.partner", "Address", required=True, index=True, ondelete="cascade"
+    )
+    commercial_partner_id = fields.Many2one(
+        "res.partner", "Commercial Partner", required=True, ondelete="cascade"
+    )
+    company_id = fields.Many2one(
+        "res.company", "Company", required=True, ondelete="cascade"
+    )
+    country_id = fields.Many2one("res.country", "Country")
+    state_id = fields.Many2one("res.country.state", "State")
+    sequence = fields.Integer(
+        help="The commercial partner exemption has precedence "
+        "over its addresses exemptions"
+    )
+    exemption_number = fields.Char("Exemption Number")
+    exemption_code_id = fields.Many2one("exemption.code", "Exemption Code")
+
+    @api.model_cr
+    def init(self):
+        create_index(
+            self._cr,
+            "res_partner_exemption_lookup_index",
+            self._table,
+            ["commercial_partner_id", "company_id", "country_id", "state_id"],
+        )
+
+    @api.model
+    def _find_exemption(self, partner, company, ship_to_address):
+        """
+        Returns the exemption to use for a document
+        invoiced to a partner and delivered to an address:
+        an exemption of the commercial partner, or of one of its addresses,
+        matching the delivery address Country and State.
+        In case there is a "country wide" exemption, the State is ignored.
+        """
+        commercial_partner = partner.commercial_partner_id
+        if not commercial_partner or not company:
+            return self.browse()
+        domain = [
+            ("commercial_partner_id", "=", commercial_partner.id),
+            ("company_id", "=", company.id),
+            ("country_id", "=", ship_to_address.country_id.id),
+        ]
+        if not commercial_partner.property_exemption_country_wide:
+            domain.append(("state_id", "=", ship_to_address.state_id.id))
+        return self.search(domain, limit=1)
+
+    @api.model
+    def _refresh_partners(self, partners):
+        """
+        Recompute the exemption index records for the given addresses,
+        for all companies.
+        """
+        partners = partners.exists()
+        index = self.sudo()
+        index.search([("partner_id", "in", partners.ids)]).unlink()
+        vals_list = []
+        for company in self.env["res.company"].sudo().search([]):
+            for partner in partners.with_context(force_company=company.id):
+                if not partner.property_tax_exempt:
+                    continue
+                commercial_partner = partner.commercial_partner_id
+                # Only the commercial partner and its direct active addresses
+                # are considered for exemptions
+                is_address = (
+                    partner.parent_id == commercial_partner and partner.active
+                )
+                if partner != commercial_partner and not is_address:
+                    continue
+                vals_list.append(
+                    {
+                        "partner_id": partner.id,
+                        "commercial_partner_id": commercial_partner.id,
+                        "company_id": company.id,
+                        "country_id": partner.country_id.id,
+                        "state_id": partner.state_id.id,
+                        "sequence": 0 if partner == commercial_partner else 1,
+                        "exemption_number": partner.property_exemption_number,
+                        "exemption_code_id": partner.property_exemption_code_id.id,
+                    }
+                )
+        if vals_list:
+            index.create(vals_list)
+        return True
+
+    @api.model
+    def _rebuild(self):
+        """ Rebuild the complete exemption index """
+        self.sudo().search([]).unlink()
+        partners = self.env["res.partner"]
+        for company in self.env["res.company"].sudo().search([]):
+            partners |= partners.with_context(
+                force_company=company.id, active_test=False
+            ).search([("property_tax_exempt", "=", True)])
+        _LOGGER.info("Building the exemption index for %d partners", len(partners))
+        return self._refresh_partners(partners)
+
 
 class ResPartner(models.Model):
     """
@@ -83,6 +213,19 @@ class ResPartner(models.Model):
         " on save before calling the wizard",
     )
     customer_code = fields.Char("Customer Code", copy=False)
+    avatax_address_hash = fields.Char(
+        "Address Fingerprint",
+        compute="_compute_avatax_address_hash",
+        store=True,
+        help="Used to detect address changes, that require a new validation",
+    )
+    avatax_validation_pending = fields.Boolean(
+        "Address Validation Pending",
+        readonly=True,
+        copy=False,
+        index=True,
+        help="The address is waiting to be validated by AvaTax",
+    )
     tax_exempt = fields.Boolean(
         "Is Tax Exempt (Deprecated))",
         deprecated=True,
@@ -130,20 +273,205 @@ class ResPartner(models.Model):
         ("name_uniq", "unique(customer_code)", "Customer Code must be unique!"),
     ]
 
+    @api.model_cr
+    def init(self):
+        super().init()
+        self._cr.execute(
+            "CREATE SEQUENCE IF NOT EXISTS res_partner_customer_code_seq"
+        )
+
+    @api.model
+    def _get_new_customer_codes(self, count):
+        """
+        Returns a list of new unique customer codes,
+        based on a timestamp, a random number and a sequence number.
+        The sequence numbers for the whole batch are reserved in one query.
+        """
+        if not count:
+            return []
+        self._cr.execute(
+            "SELECT nextval('res_partner_customer_code_seq') "
+            "FROM generate_series(1, %s)",
+            (count,),
+        )
+        timestamp = str(int(time.time()))
+        return [
+            "{}-{}-Cust-{}".format(timestamp, int(random() * 10), number)
+            for number, in self._cr.fetchall()
+        ]
+
     @api.multi
     def generate_cust_code(self):
         "Auto populate customer code"
-        for partner in self:
-            partner.customer_code = (
-                str(int(time.time()))
-                + "-"
-                + str(int(random() * 10))
-                + "-"
-                + "Cust-"
-                + str(partner.id)
+        for partner, customer_code in zip(
+            self, self._get_new_customer_codes(len(self))
+        ):
+            partner.customer_code = customer_code
+        return True
+
+    @api.model
+    def _cron_validate_pending_addresses(self, limit=500):
+        """
+        Validate the addresses left pending by batch creations,
+        or by saves when background validation is enabled.
+
+        Each partner is validated with the configuration of its company.
+        Identical addresses are validated only once,
+        and with the REST API the requests are sent concurrently.
+        Failed validations are logged, and are not retried.
+        """
+        self = self.with_context(avatax_batch=True)
+        partners = self.search(
+            [("avatax_validation_pending", "=", True)], limit=limit
+        )
+        if not partners:
+            return True
+        _LOGGER.info("Validating %d pending partner addresses", len(partners))
+        # Group the partners by company configuration,
+        # and then the partners sharing the same address
+        configs = {}
+        addresses_by_config = {}
+        read_hashes = {}
+        for vals in partners.read(
+            [
+                "street",
+                "street2",
+                "city",
+                "state_id",
+                "zip",
+                "country_id",
+                "company_id",
+                "avatax_address_hash",
+            ]
+        ):
+            read_hashes[vals["id"]] = vals["avatax_address_hash"]
+            company_id = (
+                vals["company_id"] and vals["company_id"][0]
+            ) or self.env.user.company_id.id
+            if company_id not in configs:
+                configs[company_id] = (
+                    self.env["res.company"]
+                    .browse(company_id)
+                    .get_avatax_config_company()
+                )
+            avatax_config = configs[company_id]
+            state_id = vals["state_id"] and vals["state_id"][0]
+            country_id = vals["country_id"] and vals["country_id"][0]
+            if (
+                not avatax_config
+                or avatax_config.address_validation
+                or country_id not in avatax_config.country_ids.ids
+            ):
+                continue
+            key = (
+                (vals["street"] or "").strip().upper(),
+                (vals["street2"] or "").strip().upper(),
+                (vals["city"] or "").strip().upper(),
+                (vals["zip"] or "").strip().upper(),
+                self.get_state_code(state_id) or None,
+                self.get_country_code(country_id) or None,
             )
+            partners_by_address = addresses_by_config.setdefault(avatax_config, {})
+            partners_by_address.setdefault(key, []).append(vals["id"])
+
+        Partner = self.with_context(from_validate_button=True)
+        for avatax_config, partners_by_address in addresses_by_config.items():
+            valid_addresses = self._validate_addresses_bulk(
+                avatax_config, list(partners_by_address)
+            )
+            for key, partner_ids in partners_by_address.items():
+                valid_address = valid_addresses.get(key)
+                if isinstance(valid_address, str):
+                    _LOGGER.warning(
+                        "couldn't validate address for partners %s: %s",
+                        partner_ids,
+                        valid_address,
+                    )
+                elif valid_address:
+                    vals = self._get_valid_address_vals(valid_address)
+                    vals["avatax_validation_pending"] = False
+                    unchanged_ids = self._get_address_unchanged_ids(
+                        {x: read_hashes[x] for x in partner_ids}
+                    )
+                    Partner.browse(unchanged_ids).write(vals)
+        # Addresses changed meanwhile are validated on the next run
+        self.browse(self._get_address_unchanged_ids(read_hashes)).write(
+            {"avatax_validation_pending": False}
+        )
         return True
 
+    @api.model
+    def _get_address_unchanged_ids(self, read_hashes):
+        """
+        Returns the ids of the partners still pending validation
+        with the address read, given as a dict of address hashes by id.
+        """
+        if not read_hashes:
+            return []
+        self._cr.execute(
+            "SELECT partner.id FROM res_partner partner "
+            "JOIN unnest(%s::int[], %s::varchar[]) AS address(id, hash) "
+            "ON address.id = partner.id "
+            "WHERE partner.avatax_validation_pending "
+            "AND partner.avatax_address_hash IS NOT DISTINCT FROM address.hash",
+            [list(read_hashes), list(read_hashes.values())],
+        )
+        return [x[0] for x in self._cr.fetchall()]
+
+    @api.model
+    def _validate_addresses_bulk(self, avatax_config, address_keys):
+        """
+        Validate a list of addresses,
+        given as (street, street2, city, zip, state code, country code) tuples.
+        Returns a dict mapping each address to the valid address,
+        or to the error message if it could not be validated.
+        """
+
+        def validate(key):
+            street, street2, city, zip_code, state_code, country_code = key
+            address = {
+                "street": street,
+                "street2": street2,
+                "city": city,
+                "zip": zip_code,
+            }
+            try:
+                return key, avatax.validate_rest_address(
+                    address, state_code, country_code
+                )
+            except UserError as error:
+                return key, error.name
+            except Exception as error:
+                return key, str(error)
+
+        if not address_keys:
+            return {}
+        if "rest" in avatax_config.service_url:
+            avatax = avatax_config.with_context(
+                avatax_batch=True
+            ).get_avatax_rest_service()
+            workers = min(BULK_MAX_WORKERS, len(address_keys))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return dict(executor.map(validate, address_keys))
+        # The SOAP client is not thread safe, validate sequentially
+        res = {}
+        code_to_country = self.env["res.country"]._get_avatax_code_index()[0]
+        for key in address_keys:
+            street, street2, city, zip_code, state_code, country_code = key
+            address = {
+                "street": street,
+                "street2": street2,
+                "city": city,
+                "zip": zip_code,
+                "state_id": self.get_state_id(state_code, country_code),
+                "country_id": code_to_country.get(country_code),
+            }
+            try:
+                res[key] = self._validate_address(address, avatax_config)
+            except UserError as error:
+                res[key] = error.name
+        return res
+
     def check_avatax_support(self, avatax_config, country_id):
         """ Checks if address validation pre-condition meets. """
         if avatax_config.address_validation:
@@ -170,34 +498,66 @@ class ResPartner(models.Model):
             self.property_exemption_number = ""
             self.property_exemption_code_id = None
 
+    @api.depends(*ADDRESS_FIELDS)
+    def _compute_avatax_address_hash(self):
+        for partner in self:
+            partner.avatax_address_hash = partner._get_address_hash()
+
+    def _get_address_hash(self, vals=None):
+        """
+        Returns a fingerprint of the normalized address,
+        using the values to write, if given, over the stored ones.
+        """
+        vals = vals or {}
+        parts = []
+        for field_name in ADDRESS_FIELDS:
+            value = vals[field_name] if field_name in vals else self[field_name]
+            if isinstance(value, models.BaseModel):
+                value = value.id
+            parts.append(str(value or "").strip().upper())
+        return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+    def _is_address_changed(self, vals):
+        """ Checks if writing these values changes the address """
+        self.ensure_one()
+        return self._get_address_hash(vals) != self.avatax_address_hash
+
+    @api.model
+    def _get_valid_address_vals(self, valid_address):
+        """ Returns the partner values to write for a validated address """
+        return {
+            "street": valid_address.Line1,
+            "street2": valid_address.Line2,
+            "city": valid_address.City,
+            "state_id": self.get_state_id(valid_address.Region, valid_address.Country),
+            "zip": valid_address.PostalCode,
+            "country_id": self.get_country_id(valid_address.Country),
+            "partner_latitude": valid_address.Latitude,
+            "partner_longitude": valid_address.Longitude,
+            "date_validation": time.strftime(DEFAULT_SERVER_DATE_FORMAT),
+            "validation_method": "avatax",
+            "validated_on_save": True,
+        }
+
     def get_state_id(self, code, c_code):
         """ Returns the id of the state from the code. """
-        c_id = self.env["res.country"].search([("code", "=", c_code)])[0]
-        s_id = self.env["res.country.state"].search(
-            [("code", "=", code), ("country_id", "=", c_id.id)]
-        )
-        if s_id:
-            return s_id[0].id
-        return False
+        code_to_id = self.env["res.country.state"]._get_avatax_code_index()[0]
+        return code_to_id.get((c_code, code), False)
 
     def get_country_id(self, code):
         """ Returns the id of the country from the code. """
-        country = self.env["res.country"].search([("code", "=", code)])
-        if country:
-            return country[0].id
-        return False
+        code_to_id = self.env["res.country"]._get_avatax_code_index()[0]
+        return code_to_id.get(code, False)
 
     def get_state_code(self, state_id):
         """ Returns the code from the id of the state. """
-
-        state_obj = self.env["res.country.state"]
-        return state_id and state_obj.browse(state_id).code
+        id_to_code = self.env["res.country.state"]._get_avatax_code_index()[1]
+        return state_id and id_to_code.get(state_id)
 
     def get_country_code(self, country_id):
         """ Returns the code from the id of the country. """
-
-        country_obj = self.env["res.country"]
-        return country_id and country_obj.browse(country_id).code
+        id_to_code = self.env["res.country"]._get_avatax_code_index()[1]
+        return country_id and id_to_code.get(country_id)
 
     @api.multi
     def multi_address_validation(self):
@@ -212,25 +572,7 @@ class ResPartner(models.Model):
             if avatax_config:
                 try:
                     valid_address = self._validate_address(vals, avatax_config)
-                    vals.update(
-                        {
-                            "street": valid_address.Line1,
-                            "street2": valid_address.Line2,
-                            "city": valid_address.City,
-                            "state_id": self.get_state_id(
-                                valid_address.Region, valid_address.Country
-                            ),
-                            "zip": valid_address.PostalCode,
-                            "country_id": self.get_country_id(valid_address.Country),
-                            "partner_latitude": valid_address.Latitude,
-                            "partner_longitude": valid_address.Longitude,
-                            "date_validation": time.strftime(
-                                DEFAULT_SERVER_DATE_FORMAT
-                            ),
-                            "validation_method": "avatax",
-                            "validated_on_save": True,
-                        }
-                    )
+                    vals.update(self._get_valid_address_vals(valid_address))
                     partner.write(vals)
                 except UserError as error:
                     _LOGGER.warning(
@@ -291,13 +633,9 @@ class ResPartner(models.Model):
         )
 
         if "rest" in avatax_config.service_url:
-            avatax_restpoint = AvaTaxRESTService(
-                avatax_config.account_number,
-                avatax_config.license_key,
-                avatax_config.service_url,
-                avatax_config.request_timeout,
-                avatax_config.logging,
-            )
+            avatax_restpoint = avatax_config.get_avatax_rest_service()
+            if not avatax_restpoint:
+                raise UserError(_("Avatax tax calculation is disabled."))
             valid_address = avatax_restpoint.validate_rest_address(
                 address, state_code, country_code
             )
@@ -340,7 +678,14 @@ class ResPartner(models.Model):
                 or vals.get("state_id")
             ):
                 avatax_config = self.env.user.company_id.get_avatax_config_company()
-                if avatax_config and avatax_config.validation_on_save:
+                if (
+                    avatax_config
+                    and avatax_config.validation_on_save
+                    and avatax_config.validation_deferred
+                ):
+                    # Left for the pending address validation job
+                    vals["avatax_validation_pending"] = True
+                elif avatax_config and avatax_config.validation_on_save:
                     brw_address = self.read(
                         ["street", "street2", "city", "state_id", "zip", "country_id"]
                     )[0]
@@ -385,100 +730,73 @@ class ResPartner(models.Model):
                             )
 
                         valid_address = self._validate_address(address, avatax_config)
-                        vals.update(
-                            {
-                                "street": valid_address.Line1,
-                                "street2": valid_address.Line2,
-                                "city": valid_address.City,
-                                "state_id": self.get_state_id(
-                                    valid_address.Region, valid_address.Country
-                                ),
-                                "zip": valid_address.PostalCode,
-                                "country_id": self.get_country_id(
-                                    valid_address.Country
-                                ),
-                                "partner_latitude": valid_address.Latitude,
-                                "partner_longitude": valid_address.Longitude,
-                                "date_validation": time.strftime(
-                                    DEFAULT_SERVER_DATE_FORMAT
-                                ),
-                                "validation_method": "avatax",
-                                "validated_on_save": True,
-                            }
-                        )
+                        vals.update(self._get_valid_address_vals(valid_address))
         return vals
 
     @api.model
-    def create(self, vals):
-        if vals.get("parent_id") and vals.get("use_parent_address"):
-            domain_siblings = [
-                ("parent_id", "=", vals["parent_id"]),
-                ("use_parent_address", "=", True),
-            ]
-            update_ids = [vals["parent_id"]] + self.search(domain_siblings)
-            vals = self.update_addresses(update_ids, vals)
-        else:
-            address = vals
-            if (
-                vals.get("street")
-                or vals.get("street2")
-                or vals.get("zip")
-                or vals.get("city")
-                or vals.get("country_id")
-                or vals.get("state_id")
-            ):
-                # It will work when user want to validate address at customer creation,
-                # check option in avalara api form
-                avatax_config = self.env.user.company_id.get_avatax_config_company()
-                if avatax_config and avatax_config.validation_on_save:
+    def _has_address_vals(self, vals):
+        return any(
+            vals.get(x)
+            for x in ["street", "street2", "zip", "city", "country_id", "state_id"]
+        )
 
-                    if self.check_avatax_support(
-                        avatax_config, address.get("country_id")
-                    ):
-                        valid_address = self._validate_address(address, avatax_config)
-                        vals.update(
-                            {
-                                "street": valid_address.Line1,
-                                "street2": valid_address.Line2,
-                                "city": valid_address.City,
-                                "state_id": self.get_state_id(
-                                    valid_address.Region, valid_address.Country
-                                ),
-                                "zip": valid_address.PostalCode,
-                                "country_id": self.get_country_id(
-                                    valid_address.Country
-                                ),
-                                "partner_latitude": valid_address.Latitude,
-                                "partner_longitude": valid_address.Longitude,
-                                "date_validation": time.strftime(
-                                    DEFAULT_SERVER_DATE_FORMAT
-                                ),
-                                "validation_method": "avatax",
-                                "validated_on_save": True,
-                            }
-                        )
-
-        # execute the create
-        cust_id = super(ResPartner, self).create(vals)
-
-        # Generate a detailed customer code based on timestamp, a random number, and it's  ID
-        customer_code = (
-            str(int(time.time()))
-            + "-"
-            + str(int(random() * 10))
-            + "-"
-            + "Cust-"
-            + str(cust_id.id)
+    @api.model_create_multi
+    def create(self, vals_list):
+        """
+        Customer codes are generated for the whole batch before the insert.
+        When validating addresses on save, a single partner is validated
+        right away, unless background validation is enabled,
+        while batch creations, such as imports,
+        leave the validation to the pending address validation job.
+        """
+        avatax_config = self.env.user.company_id.get_avatax_config_company()
+        validation_on_save = avatax_config and avatax_config.validation_on_save
+        # Batch creations don't contact the address validation service
+        defer_validation = len(vals_list) > 1 or (
+            avatax_config and avatax_config.validation_deferred
+        )
+        customer_codes = iter(
+            self._get_new_customer_codes(
+                len([x for x in vals_list if not x.get("customer_code")])
+            )
+        )
+        for vals in vals_list:
+            if not vals.get("customer_code"):
+                vals["customer_code"] = next(customer_codes)
+            if not validation_on_save or not self._has_address_vals(vals):
+                continue
+            if defer_validation:
+                vals["avatax_validation_pending"] = True
+            elif self.check_avatax_support(avatax_config, vals.get("country_id")):
+                valid_address = self._validate_address(vals, avatax_config)
+                vals.update(self._get_valid_address_vals(valid_address))
+
+        partners = super(ResPartner, self).create(vals_list)
+        exempt_partners = self.browse(
+            [
+                partner.id
+                for partner, vals in zip(partners, vals_list)
+                if vals.get("property_tax_exempt")
+            ]
         )
-        # Auto populate customer code
-        cust_id.write({"customer_code": customer_code})
-        return cust_id
+        if exempt_partners:
+            exempt_partners._refresh_exemption_index()
+        return partners
 
     @api.multi
     def write(self, vals):
-        if any(
+        address_written = any(
             address_field in vals for address_field in ADDRESS_FIELDS
-        ) and not vals.get("date_validation"):
+        ) and not vals.get("date_validation")
+        if address_written:
+            # Writes not changing the address keep the validation status,
+            # and don't need a new validation
+            unchanged = self.filtered(lambda x: not x._is_address_changed(vals))
+            if unchanged and unchanged != self:
+                res = unchanged.write(dict(vals))
+                return (self - unchanged).write(dict(vals)) and res
+            address_written = not unchanged
+        if address_written:
             vals.update(
                 {
                     "partner_latitude": "",
@@ -489,7 +807,29 @@ class ResPartner(models.Model):
                 }
             )
         # Follow the normal write process if it's a write operation from the wizard
-        if self.env.context.get("from_validate_button", False):
-            return super(ResPartner, self).write(vals)
-        vals1 = self.update_addresses(vals, True)
-        return super(ResPartner, self).write(vals1)
+        from_validate_button = self.env.context.get("from_validate_button", False)
+        if from_validate_button or not address_written:
+            res = super(ResPartner, self).write(vals)
+        else:
+            vals = self.update_addresses(vals, True)
+            res = super(ResPartner, self).write(vals)
+        if EXEMPTION_INDEX_FIELDS.intersection(vals):
+            self._refresh_exemption_index()
+        if (
+            ORIGIN_FIELDS.intersection(vals)
+            and self.env["res.company"]._is_avatax_origin_partner(self.ids)
+        ):
+            # Ship from values are cached by company and warehouse
+            self.clear_caches()
+        return res
+
+    @api.multi
+    def _refresh_exemption_index(self):
+        """
+        Update the exemption index for these partners.
+        Their addresses are also refreshed,
+        since their commercial partner may have changed.
+        """
+        partners = self.with_context(active_test=False)
+        partners |= partners.mapped("child_ids")
+        self.env["res.partner.exemption"]._refresh_partners(partners)
@@ -27,6 +27,16 @@ class ProductTaxCode(models.Model):
     )
     company_id = fields.Many2one("res.company")
 
+    @api.multi
+    def write(self, vals):
+        res = super(ProductTaxCode, self).write(vals)
+        if "name" in vals and self:
+            self.env["product.product"]._update_avatax_tax_code(
+                "(tmpl_code.id IN %s OR categ_code.id IN %s)",
+                [tuple(self.ids), tuple(self.ids)],
+            )
+        return res
+
 
 class ProductTemplate(models.Model):
     _inherit = "product.template"
@@ -43,12 +53,16 @@ class ProductTemplate(models.Model):
 
     @api.model
     def create(self, vals):
-        p_brw = super(ProductTemplate, self).create(vals)
-        if p_brw.categ_id.tax_code_id:
-            p_brw.write({"tax_code_id": p_brw.categ_id.tax_code_id.id})
-        else:
-            p_brw.write({"tax_code_id": False})
-        return p_brw
+        if not vals.get("tax_code_id"):
+            # The category given, or else the default category
+            if "categ_id" in vals:
+                categ_id = vals["categ_id"]
+            else:
+                categ_id = self.default_get(["categ_id"]).get("categ_id")
+            if categ_id:
+                categ = self.env["product.category"].browse(categ_id)
+                vals["tax_code_id"] = categ.tax_code_id.id
+        return super(ProductTemplate, self).create(vals)
 
     @api.multi
     def write(self, vals):
@@ -58,7 +72,70 @@ class ProductTemplate(models.Model):
                 vals["tax_code_id"] = p_brw.tax_code_id.id
             else:
                 vals["tax_code_id"] = False
-        return super(ProductTemplate, self).write(vals)
+        res = super(ProductTemplate, self).write(vals)
+        if "tax_code_id" in vals and self:
+            self.env["product.product"]._update_avatax_tax_code(
+                "tmpl.id IN %s", [tuple(self.ids)]
+            )
+        return res
+
+
+class ProductProduct(models.Model):
+    _inherit = "product.product"
+
+    avatax_tax_code = fields.Char(
+        "Effective Tax Code",
+        readonly=True,
+        index=True,
+        help="AvaTax Tax Code used for this product: "
+        "the product Tax Code, or else the product category Tax Code",
+    )
+
+    @api.model
+    def _update_avatax_tax_code(self, where="TRUE", params=None):
+        """
+        Set the effective Tax Code on the products matching the where clause,
+        with a single SQL statement, so that changes on categories
+        can be propagated to many products.
+        The where clause can use the tmpl, categ, tmpl_code and categ_code
+        table aliases.
+        """
+        self.env.cr.execute(
+            """
+            UPDATE product_product product
+            SET avatax_tax_code = COALESCE(tmpl_code.name, categ_code.name)
+            FROM product_template tmpl
+            LEFT JOIN product_tax_code tmpl_code
+              ON tmpl_code.id = tmpl.tax_code_id
+            LEFT JOIN product_category categ ON categ.id = tmpl.categ_id
+            LEFT JOIN product_tax_code categ_code
+              ON categ_code.id = categ.tax_code_id
+            WHERE product.product_tmpl_id = tmpl.id
+              AND product.avatax_tax_code
+                  IS DISTINCT FROM COALESCE(tmpl_code.name, categ_code.name)
+              AND {where}
+            """.format(
+                where=where
+            ),
+            params or [],
+        )
+        count = self.env.cr.rowcount
+        self.invalidate_cache(["avatax_tax_code"])
+        return count
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        products = super(ProductProduct, self).create(vals_list)
+        if products:
+            self._update_avatax_tax_code("product.id IN %s", [tuple(products.ids)])
+        return products
+
+    @api.multi
+    def write(self, vals):
+        res = super(ProductProduct, self).write(vals)
+        if "product_tmpl_id" in vals and self:
+            self._update_avatax_tax_code("product.id IN %s", [tuple(self.ids)])
+        return res
 
 
 class ProductCategory(models.Model):
@@ -67,3 +144,21 @@ class ProductCategory(models.Model):
     tax_code_id = fields.Many2one(
         "product.tax.code", "Tax Code", help="AvaTax Tax Code"
     )
+
+    @api.multi
+    def write(self, vals):
+        if "tax_code_id" in vals:
+            # Products using the previous category Tax Code follow the new one
+            for categ in self.filtered("tax_code_id"):
+                self.env.cr.execute(
+                    "UPDATE product_template SET tax_code_id = %s "
+                    "WHERE categ_id = %s AND tax_code_id = %s",
+                    (vals["tax_code_id"] or None, categ.id, categ.tax_code_id.id),
+                )
+            self.env["product.template"].invalidate_cache(["tax_code_id"])
+        res = super(ProductCategory, self).write(vals)
+        if "tax_code_id" in vals and self:
+            self.env["product.product"]._update_avatax_tax_code(
+                "categ.id IN %s", [tuple(self.ids)]
+            )
+        return res
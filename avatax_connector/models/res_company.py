@@ -1,5 +1,6 @@
 import logging
-from odoo import models, _
+from odoo import api, models, tools, _
+from .avatax_rest_api import get_address_payload
 
 
 _LOGGER = logging.getLogger(__name__)
@@ -26,3 +27,82 @@ class Company(models.Model):
                     _("Company %s has no Avatax configuration."), self.display_name
                 )
             return res and res[0]
+
+    @api.model
+    def _get_avatax_origin_payload(self, partner):
+        """
+        Returns the ship from values of a partner address, used by the tax
+        requests: the validation status, the REST address payload,
+        and the SOAP BaseAddress values.
+        """
+        if not partner:
+            return None
+        return {
+            "partner_id": partner.id,
+            "validated": bool(partner.date_validation),
+            "address": get_address_payload(partner),
+            "soap_address": (
+                partner.street or None,
+                partner.street2 or None,
+                partner.city,
+                partner.zip,
+                partner.state_id.code or None,
+                partner.country_id.code or None,
+            ),
+        }
+
+    @api.model
+    @tools.ormcache("company_id", "warehouse_id")
+    def _get_avatax_origin_values(self, company_id, warehouse_id):
+        """
+        Ship from values of a company warehouse, or of the company.
+        Kept in the registry cache, until the address changes.
+        The returned dict is shared, and must not be modified.
+        """
+        warehouse = self.env["stock.warehouse"].sudo().browse(warehouse_id)
+        company = self.sudo().browse(company_id)
+        return self._get_avatax_origin_payload(
+            warehouse.partner_id or company.partner_id
+        )
+
+    def get_avatax_origin(self, warehouse=None):
+        """ Returns the ship from values for a warehouse of the Company """
+        self.ensure_one()
+        return self._get_avatax_origin_values(self.id, warehouse and warehouse.id)
+
+    @api.model
+    def _is_avatax_origin_partner(self, partner_ids):
+        """ Checks if any of these partners is a company or warehouse address """
+        if not partner_ids:
+            return False
+        self.env.cr.execute(
+            """
+            SELECT 1 FROM res_company WHERE partner_id IN %s
+            UNION ALL
+            SELECT 1 FROM stock_warehouse WHERE partner_id IN %s
+            LIMIT 1
+            """,
+            [tuple(partner_ids), tuple(partner_ids)],
+        )
+        return bool(self.env.cr.fetchone())
+
+    @api.multi
+    def write(self, vals):
+        if "partner_id" in vals:
+            self.clear_caches()
+        return super().write(vals)
+
+
+class StockWarehouse(models.Model):
+    _inherit = "stock.warehouse"
+
+    @api.multi
+    def write(self, vals):
+        if "partner_id" in vals or "company_id" in vals:
+            self.clear_caches()
+        return super().write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super().unlink()
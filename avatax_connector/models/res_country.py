@@ -0,0 +1,76 @@
+from odoo import api, models, tools
+
+
+class ResCountry(models.Model):
+    _inherit = "res.country"
+
+    @api.model
+    @tools.ormcache()
+    def _get_avatax_code_index(self):
+        """
+        Returns a pair of dicts, mapping country codes to ids and ids to codes.
+        Kept in the registry cache, to avoid queries on every address validation.
+        """
+        self.env.cr.execute("SELECT id, code FROM res_country")
+        rows = self.env.cr.fetchall()
+        return (
+            {code: country_id for country_id, code in rows},
+            {country_id: code for country_id, code in rows},
+        )
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.clear_caches()
+        return super().create(vals_list)
+
+    @api.multi
+    def write(self, vals):
+        if "code" in vals:
+            self.clear_caches()
+        return super().write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super().unlink()
+
+
+class ResCountryState(models.Model):
+    _inherit = "res.country.state"
+
+    @api.model
+    @tools.ormcache()
+    def _get_avatax_code_index(self):
+        """
+        Returns a pair of dicts, mapping (country code, state code) pairs
+        to state ids, and state ids to state codes.
+        Kept in the registry cache, to avoid queries on every address validation.
+        """
+        self.env.cr.execute(
+            """
+            SELECT state.id, state.code, country.code
+            FROM res_country_state state
+            JOIN res_country country ON country.id = state.country_id
+            """
+        )
+        rows = self.env.cr.fetchall()
+        return (
+            {(country_code, code): state_id for state_id, code, country_code in rows},
+            {state_id: code for state_id, code, country_code in rows},
+        )
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.clear_caches()
+        return super().create(vals_list)
+
+    @api.multi
+    def write(self, vals):
+        if "code" in vals or "country_id" in vals:
+            self.clear_caches()
+        return super().write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super().unlink()
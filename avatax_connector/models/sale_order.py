@@ -1,6 +1,13 @@
+import logging
+from datetime import datetime, timedelta
 from odoo import api, fields, models, _
 import odoo.addons.decimal_precision as dp
 from odoo.exceptions import UserError
+from .avatax_lock import lock_documents, try_lock_documents
+from .avatax_profiler import avatax_profiled
+
+
+_logger = logging.getLogger(__name__)
 
 
 class SaleOrder(models.Model):
@@ -23,27 +30,13 @@ class SaleOrder(models.Model):
 
     @api.depends("tax_add_id", "partner_invoice_id", "partner_id", "company_id")
     def _compute_onchange_exemption(self):
+        Exemption = self.env["res.partner.exemption"]
         for order in self:
-            # Find an exemption address matching the Country + State
-            # of the Delivery address
-            invoice_partner = order.partner_invoice_id.commercial_partner_id
-            ship_to_address = order.tax_add_id
-            exemption_addresses = (
-                invoice_partner | invoice_partner.child_ids
-            ).filtered("property_tax_exempt")
-            exemption_address_naive = exemption_addresses.filtered(
-                lambda a: a.country_id == ship_to_address.country_id
-                and (
-                    a.state_id == ship_to_address.state_id
-                    or invoice_partner.property_exemption_country_wide
-                )
-            )[:1]
-            # Force Company to get the correct values form the Property fields
-            exemption_address = exemption_address_naive.with_context(
-                force_company=order.company_id.id
+            exemption = Exemption._find_exemption(
+                order.partner_invoice_id, order.company_id, order.tax_add_id
             )
-            order.exemption_code = exemption_address.property_exemption_number
-            order.exemption_code_id = exemption_address.property_exemption_code_id
+            order.exemption_code = exemption.exemption_number
+            order.exemption_code_id = exemption.exemption_code_id
 
     @api.multi
     def _prepare_invoice(self):
@@ -159,6 +152,79 @@ class SaleOrder(models.Model):
     )
     tax_address = fields.Text("Tax Address Text")
     location_code = fields.Char("Location Code", help="Origin address location code")
+    avatax_dirty_date = fields.Datetime(
+        "Avatax Computation Pending Since",
+        readonly=True,
+        copy=False,
+        index=True,
+        help="Lines changed, and the taxes will be computed in background",
+    )
+
+    @api.model
+    def create(self, vals):
+        order = super().create(vals)
+        if vals.get("order_line"):
+            order._avatax_mark_dirty()
+        return order
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if {"order_line", "fiscal_position_id", "partner_shipping_id"} & set(vals):
+            # The readonly fingerprints reset by the onchange are not saved
+            self.mapped("order_line").filtered("avatax_fingerprint").write(
+                {"avatax_fingerprint": False}
+            )
+        if vals.get("order_line"):
+            self._avatax_mark_dirty()
+        return res
+
+    def _avatax_mark_dirty(self):
+        """
+        With a debounced immediate calculation, flag the quotations
+        for a background tax computation, instead of contacting Avatax
+        on every line change.
+        """
+        quotations = self.filtered(lambda x: x.state in ["draft", "sent"])
+        debounced = {
+            company: company.get_avatax_config_company()._is_calculation_debounced()
+            for company in quotations.mapped("company_id")
+        }
+        dirty = quotations.filtered(lambda x: debounced[x.company_id])
+        if dirty:
+            super(SaleOrder, dirty).write({"avatax_dirty_date": fields.Datetime.now()})
+
+    @api.model
+    def _cron_avatax_compute_dirty(self, limit=100):
+        """
+        Compute the taxes of the quotations with line changes older than
+        the configured delay. The users see the new totals when the
+        documents are reloaded.
+        """
+        orders = self.search(
+            [("avatax_dirty_date", "!=", False), ("state", "in", ["draft", "sent"])],
+            order="avatax_dirty_date",
+            limit=limit,
+        )
+        now = datetime.now()
+        for order in orders:
+            avatax_config = order.company_id.get_avatax_config_company()
+            delay = timedelta(seconds=avatax_config.immediate_calculation_delay)
+            if order.avatax_dirty_date + delay > now:
+                continue
+            if try_lock_documents(order):
+                continue  # Being computed in another session, retry later
+            try:
+                with self.env.cr.savepoint():
+                    order._avalara_compute_taxes()
+            except Exception as error:
+                _logger.warning(
+                    "Avatax background computation failed for order %s: %s",
+                    order.id,
+                    error,
+                )
+            super(SaleOrder, order).write({"avatax_dirty_date": False})
+        return True
 
     @api.onchange("order_line", "fiscal_position_id", "partner_shipping_id")
     def onchange_reset_avatax_amount(self):
@@ -171,6 +237,7 @@ class SaleOrder(models.Model):
             order.tax_amount = 0
             for line in order.order_line:
                 line.tax_amt = 0
+                line.avatax_fingerprint = False
 
     def _get_avatax_doc_type(self, commit=False):
         return "SalesOrder"
@@ -216,13 +283,14 @@ class SaleOrder(models.Model):
         tax_amount = o_tax_amt = 0.0
 
         # ship from Address / Origin Address either warehouse or company if none
-        ship_from_address_id = (
-            self.warehouse_id.partner_id or self.company_id.partner_id
-        )
+        ship_from_address_id = self.company_id.get_avatax_origin(self.warehouse_id)
 
         compute_taxes = (
             self.env.context.get("avatax_recomputation")
-            or avatax_config.enable_immediate_calculation
+            or (
+                avatax_config.enable_immediate_calculation
+                and not avatax_config._is_calculation_debounced()
+            )
         )
         if compute_taxes:
             ava_tax = account_tax_obj.search(
@@ -264,7 +332,7 @@ class SaleOrder(models.Model):
                             self.exemption_code_id.code or None,
                             currency_id=self.currency_id,
                         )
-                        ol_tax_amt = tax_result.TotalTax
+                        ol_tax_amt = tax_result.total_tax
                         o_tax_amt += (
                             ol_tax_amt  # tax amount based on total order line total
                         )
@@ -289,7 +357,7 @@ class SaleOrder(models.Model):
                         self.exemption_code_id.code or None,
                         currency_id=self.currency_id,
                     )
-                    tax_amount = tax_result.TotalTax
+                    tax_amount = tax_result.total_tax
 
                     for o_line in self.order_line:
                         o_line.write({"tax_amt": 0.0})
@@ -306,11 +374,21 @@ class SaleOrder(models.Model):
         self.write({"tax_amount": tax_amount, "order_line": []})
         return True
 
+    def _avatax_is_profiling(self):
+        """ Profile the Avatax computations for these orders """
+        return bool(
+            self.env.context.get("avatax_profile")
+            or self[:1].company_id.id
+            in self.env["avalara.salestax"]._get_profiling_company_ids()
+        )
+
+    @avatax_profiled
     def _avatax_compute_tax(self):
         """ Contact REST API and recompute taxes for a Sale Order """
         self and self.ensure_one()
         doc_type = self._get_avatax_doc_type()
         Tax = self.env["account.tax"]
+        Invoice = self.env["account.invoice"]
         avatax_config = self.company_id.get_avatax_config_company()
         taxable_lines = self._avatax_prepare_lines(doc_type)
         tax_result = avatax_config.create_transaction(
@@ -318,7 +396,7 @@ class SaleOrder(models.Model):
             self.name,
             doc_type,
             self.partner_id,
-            self.warehouse_id.partner_id or self.company_id.partner_id,
+            self.company_id.get_avatax_origin(self.warehouse_id),
             self.partner_shipping_id or self.partner_id,
             taxable_lines,
             self.user_id,
@@ -326,17 +404,30 @@ class SaleOrder(models.Model):
             self.exemption_code_id.code or None,
             currency_id=self.currency_id,
         )
-        tax_result_lines = {int(x["lineNumber"]): x for x in tax_result["lines"]}
         for line in self.order_line:
-            tax_result_line = tax_result_lines.get(line.id)
-            if tax_result_line:
-                rate = tax_result_line.get("rate", doc_type)
+            if line.id in tax_result:
+                rate = tax_result.get_rate(line.id)
                 tax = Tax.get_avalara_tax(rate, doc_type)
                 if tax and not (tax == line.tax_id.filtered("is_avatax")):
                     non_avataxes = line.tax_id.filtered(lambda x: not x.is_avatax)
                     line.tax_id = non_avataxes | tax
-                line.tax_amt = tax_result_line["tax"]
-        self.tax_amount = tax_result.get("totalTax")
+                line.tax_amt = tax_result.get_tax(line.id)
+        # Allows Invoices with the same lines to reuse this computation
+        ship_from = self.warehouse_id.partner_id or self.company_id.partner_id
+        ship_to = self.partner_shipping_id or self.partner_id
+        for line in taxable_lines:
+            if line["id"].id in tax_result:
+                line["id"].avatax_fingerprint = Invoice._avatax_get_line_fingerprint(
+                    self.partner_id,
+                    ship_from,
+                    ship_to,
+                    self.exemption_code,
+                    self.exemption_code_id.code,
+                    self.currency_id,
+                    line,
+                    self.date_order,
+                )
+        self.tax_amount = tax_result.total_tax
         # Force tax totals recomputation, to ensure teh Avatax amount is applied
         self._amount_all()
         return True
@@ -344,6 +435,8 @@ class SaleOrder(models.Model):
     @api.multi
     def _avalara_compute_taxes(self):
         self and self.ensure_one()
+        # At most one calculation in progress per order
+        lock_documents(self)
         has_avatax_tax = self.mapped("order_line.tax_id.is_avatax")
         avatax_config = self.company_id.get_avatax_config_company()
         if not (has_avatax_tax and avatax_config):
@@ -387,6 +480,24 @@ class SaleOrderLine(models.Model):
     _inherit = "sale.order.line"
 
     tax_amt = fields.Float("Avalara Tax", help="tax calculate by avalara")
+    avatax_fingerprint = fields.Char(
+        "Avatax Data Fingerprint",
+        readonly=True,
+        copy=False,
+        help="Fingerprint of the line data used for the last Avatax computation",
+    )
+
+    @api.multi
+    def write(self, vals):
+        if "avatax_fingerprint" not in vals and {
+            "product_uom_qty",
+            "discount",
+            "price_unit",
+            "tax_id",
+        } & set(vals):
+            # The readonly fingerprint reset by the onchange is not saved
+            vals = dict(vals, avatax_fingerprint=False)
+        return super().write(vals)
 
     @api.onchange("product_uom_qty", "discount", "price_unit", "tax_id")
     def onchange_reset_avatax_amount(self):
@@ -397,6 +508,7 @@ class SaleOrderLine(models.Model):
         """
         for line in self:
             line.tax_amt = 0
+            line.avatax_fingerprint = False
             line.order_id.tax_amount = 0
 
     def _avatax_prepare_line(self, sign=1, doc_type=None):
@@ -413,10 +525,7 @@ class SaleOrderLine(models.Model):
                 item_code = "upc:" + line.product_id.barcode
             else:
                 item_code = line.product_id.default_code
-            tax_code = (
-                line.product_id.tax_code_id.name
-                or line.product_id.categ_id.tax_code_id.name
-            )
+            tax_code = line.product_id.avatax_tax_code
             amount = (
                 sign
                 * line.price_unit
@@ -458,9 +567,10 @@ class SaleOrderLine(models.Model):
     @api.depends("product_uom_qty", "discount", "price_unit", "tax_id", "tax_amt")
     def _compute_amount(self):
         """
-        If we have a Avatax computed amount, use it instead of the Odoo computed one
+        If we have a Avatax computed amount, use it instead of the Odoo computed one.
+        Reproduces the original code, not called, to compute the taxes only once,
+        with the current line in the context.
         """
-        super()._compute_amount()
         for line in self:
             # Use line price
             price = line.price_unit * (1 - (line.discount or 0.0) / 100.0)
@@ -472,9 +582,16 @@ class SaleOrderLine(models.Model):
                 product=line.product_id,
                 partner=line.order_id.partner_shipping_id,
             )
-            vals = {
-                "price_tax": taxes["total_included"] - taxes["total_excluded"],
-                "price_total": taxes["total_included"],
-                "price_subtotal": taxes["total_excluded"],
-            }
-            line.update(vals)
+            line.update(line._get_avatax_amount_vals(taxes))
+
+    def _get_avatax_amount_vals(self, taxes):
+        """
+        Returns the line amounts to set, from the Tax.compute_all() result.
+        Extension point for modules needing other amounts from the same
+        computation, to avoid calling compute_all() again.
+        """
+        return {
+            "price_tax": taxes["total_included"] - taxes["total_excluded"],
+            "price_total": taxes["total_included"],
+            "price_subtotal": taxes["total_excluded"],
+        }
@@ -1,5 +1,20 @@
+import hashlib
+import threading
+import time
+import tracemalloc
+import zlib
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+from odoo import SUPERUSER_ID, api, fields
+from odoo.sql_db import db_connect
 from odoo.tests.common import TransactionCase
 from odoo.exceptions import UserError
+from odoo.addons.avatax_connector.models.avatax_lock import (
+    lock_documents,
+    try_lock_documents,
+)
+from odoo.addons.avatax_connector.models.avatax_rest_api import single_flight
+from odoo.addons.avatax_connector.models.avatax_result import AvaTaxResult
 
 
 class TestConfig(TransactionCase):
@@ -22,3 +37,435 @@ class TestConfig(TransactionCase):
         self.avatax_config.account_number = "X"
         with self.assertRaises(UserError):
             Wizard.with_context(active_id=active_id).ping()
+
+    def test_profiling_flag(self):
+        "Enabling profiling is seen by the cached profiling flag"
+        invoice = self.env["account.invoice"].new(
+            {"company_id": self.avatax_config.company_id.id}
+        )
+        self.avatax_config.profiling = False
+        self.assertFalse(invoice._avatax_is_profiling())
+        self.avatax_config.profiling = True
+        self.assertTrue(invoice._avatax_is_profiling())
+
+    def test_dirty_crons(self):
+        "The changed documents crons only run with a debounced calculation"
+        cron = self.env.ref("avatax_connector.ir_cron_compute_dirty_invoice_taxes")
+        self.avatax_config.write(
+            {"enable_immediate_calculation": True, "immediate_calculation_delay": 5}
+        )
+        self.assertTrue(cron.active)
+        self.avatax_config.immediate_calculation_delay = 0
+        self.assertFalse(cron.active)
+
+
+class TestExemptionIndex(TransactionCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.company = self.env.user.company_id
+        self.state_ca = self.env.ref("base.state_us_5")
+        self.state_ny = self.env.ref("base.state_us_27")
+        self.exemption_code = self.env.ref("avatax_connector.resale_type")
+        self.customer = self.env["res.partner"].create(
+            {
+                "name": "ACME",
+                "is_company": True,
+                "country_id": self.env.ref("base.us").id,
+            }
+        )
+        self.delivery = self.env["res.partner"].create(
+            {
+                "name": "ACME Delivery",
+                "parent_id": self.customer.id,
+                "type": "delivery",
+                "country_id": self.env.ref("base.us").id,
+                "state_id": self.state_ca.id,
+            }
+        )
+
+    def test_exemption_index_maintained_on_write(self):
+        "Exemption index follows the partner exemption changes"
+        Exemption = self.env["res.partner.exemption"]
+        self.assertFalse(
+            Exemption._find_exemption(self.customer, self.company, self.delivery)
+        )
+        self.delivery.write(
+            {
+                "property_tax_exempt": True,
+                "property_exemption_number": "CA-123",
+                "property_exemption_code_id": self.exemption_code.id,
+            }
+        )
+        exemption = Exemption._find_exemption(
+            self.customer, self.company, self.delivery
+        )
+        self.assertEqual(exemption.exemption_number, "CA-123")
+        self.assertEqual(exemption.exemption_code_id, self.exemption_code)
+        self.delivery.state_id = self.state_ny
+        ship_to_ca = self.env["res.partner"].new(
+            {"country_id": self.env.ref("base.us").id, "state_id": self.state_ca.id}
+        )
+        self.assertFalse(
+            Exemption._find_exemption(self.customer, self.company, ship_to_ca)
+        )
+
+
+class TestAvaTaxResult(TransactionCase):
+
+    def _get_rest_result(self, line_count):
+        detail = {
+            "jurisdictionType": "State",
+            "jurisName": "CALIFORNIA",
+            "taxName": "CA STATE TAX",
+            "rate": 0.0725,
+            "tax": 0.73,
+            "taxableAmount": 10.0,
+        }
+        return {
+            "totalTax": 0.73 * line_count,
+            "lines": [
+                {
+                    "lineNumber": str(i),
+                    "tax": 0.73,
+                    "rate": 7.25,
+                    "taxableAmount": 10.0,
+                    "details": [dict(detail) for x in range(4)],
+                }
+                for i in range(1, line_count + 1)
+            ],
+        }
+
+    def test_compact_result(self):
+        "Compact result keeps the line taxes and rates, in less memory"
+        tracemalloc.start()
+        try:
+            result = self._get_rest_result(5000)
+            rest_size = tracemalloc.get_traced_memory()[0]
+            compact = AvaTaxResult.from_rest(result)
+            compact_size = tracemalloc.get_traced_memory()[0] - rest_size
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(len(compact), 5000)
+        self.assertAlmostEqual(compact.get_tax(42), 0.73)
+        self.assertAlmostEqual(compact.get_rate(42), 7.25)
+        self.assertEqual(compact.get_tax(5001), 0.0)
+        # About 7 MB for the response, and 0.6 MB for the compact result
+        self.assertLess(compact_size * 5, rest_size)
+
+    def test_soap_result_new_lines(self):
+        "SOAP result of lines not saved yet, computed in onchanges"
+        line = self.env["account.invoice.line"].new({"name": "Onchange"})
+        tax_line = SimpleNamespace(No="0", Tax="0.73", Rate="0.0725", Taxable="10")
+        result = SimpleNamespace(
+            TotalTax="0.73", TaxLines=SimpleNamespace(TaxLine=[tax_line])
+        )
+        compact = AvaTaxResult.from_soap(result, [{"id": line}])
+        self.assertIn(line.id, compact)
+        self.assertAlmostEqual(compact.get_tax(line.id), 0.73)
+        self.assertAlmostEqual(compact.get_rate(line.id), 7.25)
+
+
+class TestThrottle(TransactionCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        # The throttle uses its own cursors: share the test transaction
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        self.avatax_config = self.env["avalara.salestax"].create(
+            {
+                "account_number": "X",
+                "license_key": "X",
+                "company_code": "THROTTLE",
+                "company_id": self.env.user.company_id.id,
+                "rate_limit": 1,
+            }
+        )
+
+    def test_batch_rate_limit_one(self):
+        "Batch requests are not blocked with a limit of one request per second"
+        avatax_config = self.avatax_config.with_context(avatax_batch=True)
+        start = time.time()
+        self.assertEqual(avatax_config._avatax_throttle(), 0.0)
+        self.assertGreater(avatax_config._avatax_throttle(), 0.0)
+        self.assertLess(time.time() - start, 3)
+
+    def test_token_accounting(self):
+        "Throttle counts the requests, and the ones that waited for a token"
+        self.assertEqual(self.avatax_config._avatax_throttle(), 0.0)
+        self.assertGreater(self.avatax_config._avatax_throttle(), 0.0)
+        self.cr.execute(
+            "SELECT request_count, wait_count, wait_time "
+            "FROM avalara_salestax_rate_bucket WHERE config_id = %s",
+            [self.avatax_config.id],
+        )
+        request_count, wait_count, wait_time = self.cr.fetchone()
+        self.assertEqual(request_count, 2)
+        self.assertEqual(wait_count, 1)
+        self.assertGreater(wait_time, 0.0)
+
+
+class TestSharedFlight(TransactionCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.key = hashlib.sha1(
+            ("test_shared_flight %s" % time.time()).encode("utf-8")
+        ).hexdigest()
+        self.addCleanup(self._delete_flight_result)
+
+    def _delete_flight_result(self):
+        with self.registry.cursor() as cr:
+            cr.execute(
+                "DELETE FROM avalara_salestax_flight WHERE fingerprint = %s",
+                [self.key],
+            )
+
+    def _get_transport(self):
+        """ Mocked Avatax call, slow enough for the callers to overlap """
+
+        def create_transaction():
+            time.sleep(0.5)
+            return {"totalTax": 7.25}
+
+        return Mock(side_effect=create_transaction)
+
+    def _run_threads(self, target, count):
+        barrier = threading.Barrier(count)
+        results = []
+
+        def run():
+            barrier.wait()
+            results.append(target())
+
+        threads = [threading.Thread(target=run) for x in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_single_flight_threads(self):
+        "Identical concurrent calculations of a process call Avatax once"
+        transport = self._get_transport()
+        results = self._run_threads(lambda: single_flight(self.key, transport), 3)
+        self.assertEqual(transport.call_count, 1)
+        self.assertEqual(results, [{"totalTax": 7.25}] * 3)
+
+    def test_shared_flight_workers(self):
+        "Identical concurrent calculations of different workers call Avatax once"
+        transport = self._get_transport()
+
+        def calculate():
+            # Each worker has its own database connection
+            with self.registry.cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                return env["avalara.salestax"]._avatax_shared_flight(
+                    self.key, transport
+                )
+
+        results = self._run_threads(calculate, 2)
+        self.assertEqual(transport.call_count, 1)
+        self.assertEqual(results, [{"totalTax": 7.25}] * 2)
+
+
+class TestDocumentLock(TransactionCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.partner = self.env["res.partner"].create({"name": "Locked"})
+
+    def test_lock_uncontended(self):
+        "A document can be locked again by the same transaction"
+        self.assertFalse(try_lock_documents(self.partner))
+        self.assertTrue(lock_documents(self.partner))
+        self.assertFalse(try_lock_documents(self.partner))
+
+    def test_lock_contended(self):
+        "A document locked by another transaction is reported busy"
+        other_cr = db_connect(self.cr.dbname).cursor()
+        self.addCleanup(other_cr.close)
+        self.addCleanup(other_cr.rollback)
+        namespace = zlib.crc32(b"res.partner") & 0x7FFFFFFF
+        other_cr.execute(
+            "SELECT pg_advisory_xact_lock(%s, %s)", [namespace, self.partner.id]
+        )
+        other = self.env["res.partner"].create({"name": "Free"})
+        self.assertEqual(try_lock_documents(self.partner | other), self.partner)
+        with self.assertRaises(UserError):
+            lock_documents(self.partner)
+        other_cr.rollback()
+        self.assertFalse(try_lock_documents(self.partner))
+
+
+class TestBackfill(TransactionCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        company = self.env.user.company_id
+        self.avatax_config = self.env["avalara.salestax"].create(
+            {
+                "account_number": "X",
+                "license_key": "X",
+                "company_code": "BACKFILL",
+                "company_id": company.id,
+                "service_url": "https://sandbox-rest.avatax.com/api/v2",
+            }
+        )
+        partner = self.env["res.partner"].create({"name": "ACME"})
+        today = fields.Date.context_today(self.avatax_config)
+        self.invoices = self.env["account.invoice"]
+        for i in range(3):
+            invoice = self.env["account.invoice"].create(
+                {
+                    "partner_id": partner.id,
+                    "account_id": partner.property_account_receivable_id.id,
+                    "type": "out_invoice",
+                    "company_id": company.id,
+                }
+            )
+            # Posted without a journal entry: only the backfill query reads it
+            self.cr.execute(
+                "UPDATE account_invoice "
+                "SET state = 'open', number = %s, date_invoice = %s WHERE id = %s",
+                ["BACKFILL/%d" % i, today, invoice.id],
+            )
+            self.invoices |= invoice
+        self.invoices.invalidate_cache()
+        reconcile = self.env["avalara.salestax.reconcile"].create(
+            {
+                "avatax_config_id": self.avatax_config.id,
+                "date_from": today,
+                "date_to": today,
+                "line_ids": [
+                    (0, 0, {"invoice_id": x.id, "issue": "missing"})
+                    for x in self.invoices
+                ],
+            }
+        )
+        reconcile.state = "done"
+        self.backfill = self.env["avalara.salestax.backfill"].create(
+            {
+                "avatax_config_id": self.avatax_config.id,
+                "date_from": today,
+                "date_to": today,
+                "reconcile_id": reconcile.id,
+                "chunk_size": 2,
+            }
+        )
+        self.committed = []
+
+        def commit_invoices(backfill, invoices):
+            self.committed += invoices.ids
+            return {x: None for x in invoices.ids}
+
+        patcher = patch.object(
+            type(self.backfill), "_commit_invoices", commit_invoices
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_backfill_resume(self):
+        "A paused backfill resumes after the last processed invoice"
+        self.backfill.action_start()
+        self.assertTrue(self.backfill._run_chunk())
+        self.assertEqual(self.committed, self.invoices.ids[:2])
+        self.assertEqual(self.backfill.last_invoice_id, self.invoices.ids[1])
+        self.backfill.action_pause()
+        self.assertEqual(self.backfill.state, "paused")
+        self.backfill.action_start()
+        self.assertTrue(self.backfill._run_chunk())
+        self.assertFalse(self.backfill._run_chunk())
+        self.assertEqual(self.committed, self.invoices.ids)
+        self.assertEqual(self.backfill.committed_count, 3)
+        self.assertEqual(self.backfill.state, "done")
+
+    def test_backfill_reporting_disabled(self):
+        "Invoices posted with tax reporting disabled are backfilled"
+        invoice = self.invoices[0]
+        self.avatax_config.disable_tax_reporting = True
+        AvataxConfig = type(self.env["avalara.salestax"])
+        with patch.object(AvataxConfig, "create_transaction") as create_transaction:
+            create_transaction.return_value = AvaTaxResult()
+            invoice._avatax_compute_tax(commit=True)
+        self.assertFalse(create_transaction.call_args[0][10])  # Not committed
+        self.assertFalse(invoice.avatax_commit_date)
+        self.avatax_config.disable_tax_reporting = False
+        self.backfill.chunk_size = 10
+        self.backfill.action_start()
+        self.backfill._run_chunk()
+        self.assertIn(invoice.id, self.committed)
+
+
+
+class TestFingerprintReset(TransactionCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.partner = self.env["res.partner"].create({"name": "Fingerprint"})
+        self.product = self.env["product.product"].create({"name": "Fingerprint"})
+
+    def test_order_line_change(self):
+        "Saving a changed order line clears its Avatax fingerprint"
+        order = self.env["sale.order"].create(
+            {
+                "partner_id": self.partner.id,
+                "order_line": [
+                    (
+                        0,
+                        0,
+                        {
+                            "product_id": self.product.id,
+                            "name": self.product.name,
+                            "product_uom_qty": 1,
+                            "product_uom": self.product.uom_id.id,
+                            "price_unit": 10.0,
+                        },
+                    )
+                ],
+            }
+        )
+        line = order.order_line
+        line.avatax_fingerprint = "computed"
+        order.write({"order_line": [(1, line.id, {"price_unit": 20.0})]})
+        self.assertFalse(line.avatax_fingerprint)
+
+    def test_invoice_line_change(self):
+        "Saving a changed invoice line clears the invoice Avatax fingerprint"
+        account = self.env["account.account"].search(
+            [("internal_type", "=", "other")], limit=1
+        )
+        invoice = self.env["account.invoice"].create(
+            {
+                "partner_id": self.partner.id,
+                "account_id": self.partner.property_account_receivable_id.id,
+                "type": "out_invoice",
+                "invoice_line_ids": [
+                    (
+                        0,
+                        0,
+                        {
+                            "product_id": self.product.id,
+                            "name": self.product.name,
+                            "account_id": account.id,
+                            "quantity": 1,
+                            "price_unit": 10.0,
+                        },
+                    )
+                ],
+            }
+        )
+        invoice.avatax_fingerprint = "computed"
+        invoice.invoice_line_ids.quantity = 2
+        self.assertFalse(invoice.avatax_fingerprint)
+
+
+class TestRefundTaxDate(TransactionCase):
+
+    def test_refund_not_saved(self):
+        "Tax date of a refund being edited, not saved yet"
+        refund = self.env["account.invoice"].new(
+            {"type": "out_refund", "invoice_doc_no": "INV/MISSING"}
+        )
+        self.assertFalse(refund.get_origin_tax_date())
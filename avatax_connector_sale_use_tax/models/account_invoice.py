@@ -22,39 +22,19 @@ class AccountInvoice(models.Model):
                 sum(line.tax_expense for line in inv.invoice_line_ids)
             )
 
-    def get_taxes_values(self, contact_avatax=False, commit_avatax=False):
+    def _prepare_tax_line_vals(self, line, tax):
         """
-        Extends the standard method reponsible for computing taxes.
-        Returns a dict with the taxes values, ready to be used to create tax_line_ids.
+        Add the Tax Expense amount, returned by Tax.compute_all()
         """
-        tax_grouped = super(AccountInvoice, self).get_taxes_values()
-        avatax_config = self.company_id.get_avatax_config_company()
-        has_ava_use = any(
-            x.tax_id.is_avatax and x.tax_id.is_expensed_tax for x in self.tax_line_ids
-        )
-        if self.type in ["out_invoice", "out_refund"] and avatax_config and has_ava_use:
-            Tax = self.env["account.tax"]
-            for line in self.invoice_line_ids:
-                tax_ids = line.invoice_line_tax_ids.filtered("is_expensed_tax")
-                if not line.account_id or line.display_type or not tax_ids:
-                    continue
-                price_unit = line._get_tax_price_unit()
-                taxes = tax_ids.compute_all(
-                    price_unit,
-                    self.currency_id,
-                    line.quantity,
-                    line.product_id,
-                    self.partner_id,
-                )["taxes"]
-                for tax in taxes:
-                    val = self._prepare_tax_line_vals(line, tax)
-                    key = Tax.browse(tax["id"]).get_grouping_key(val)
-                    tax_grouped_val = tax_grouped[key]
-                    tax_grouped_val.setdefault("amount_tax_expense", 0)
-                    tax_grouped_val["amount_tax_expense"] += tax.get(
-                        "amount_expense", 0
-                    )
-        return tax_grouped
+        vals = super()._prepare_tax_line_vals(line, tax)
+        vals["amount_tax_expense"] = tax.get("amount_expense", 0)
+        return vals
+
+    def _avatax_add_grouped_tax_vals(self, tax_grouped, key, val):
+        if key in tax_grouped:
+            tax_grouped[key].setdefault("amount_tax_expense", 0)
+            tax_grouped[key]["amount_tax_expense"] += val.get("amount_tax_expense", 0)
+        return super()._avatax_add_grouped_tax_vals(tax_grouped, key, val)
 
     def tax_line_move_line_get(self):
         res = super().tax_line_move_line_get() or []
@@ -219,25 +199,36 @@ class AccountInvoiceLine(models.Model):
     )
     def _compute_price(self):
         """
-        Compute the tax_expense field.
-        Needs to be done on the same method computing the tax amount.
+        The Tax Expense fields are set by _get_avatax_amount_vals(),
+        from the same computation used for the collected tax amount.
         """
-        super()._compute_price()
-        for line in self:
-            has_expensed_tax = any(x.is_expensed_tax for x in line.invoice_line_tax_ids)
-            if has_expensed_tax:
-                currency = line.invoice_id.currency_id or None
-                price = line._get_tax_price_unit()
-                tax_ids = line.invoice_line_tax_ids.with_context(avatax_line=line)
+        # Prefetch the tax flags for the whole recordset
+        self.mapped("invoice_line_tax_ids.is_expensed_tax")
+        return super()._compute_price()
+
+    def _get_avatax_amount_vals(self, taxes, price):
+        vals = super()._get_avatax_amount_vals(taxes, price)
+        tax_expense = 0
+        if any(x.is_expensed_tax for x in self.invoice_line_tax_ids):
+            expense_price = self._get_tax_price_unit()
+            if expense_price != price:
+                # Use Tax is computed on the purchase price, not the sale price
+                tax_ids = self.invoice_line_tax_ids.with_context(avatax_line=self)
                 taxes = tax_ids.compute_all(
-                    price,
-                    currency,
-                    line.quantity,
-                    product=line.product_id,
-                    partner=line.invoice_id.partner_id,
+                    expense_price,
+                    self.invoice_id.currency_id or None,
+                    self.quantity,
+                    product=self.product_id,
+                    partner=self.invoice_id.partner_id,
                 )
-                line.tax_expense = taxes.get("total_expense", 0) if taxes else 0
-            line.tax_total = line.price_tax + line.tax_expense
+            tax_expense = taxes.get("total_expense", 0) if taxes else 0
+        vals.update(
+            {
+                "tax_expense": tax_expense,
+                "tax_total": vals["price_total"] - vals["price_subtotal"] + tax_expense,
+            }
+        )
+        return vals
 
     @api.depends("purchase_price", "price_subtotal", "tax_expense")
     def _compute_margin(self):
@@ -34,9 +34,14 @@ class AccountTax(models.Model):
         taxes = super().compute_all(price_unit, currency, quantity, product, partner)
         avatax_line = self.env.context.get("avatax_line")
         taxes["total_expense"] = 0
+        # Read the tax flags for all the returned taxes at once
+        expensed_tax_ids = set(
+            self.browse([x["id"] for x in taxes["taxes"]])
+            .filtered(lambda x: x.is_expensed_tax and x.amount)
+            .ids
+        )
         for tax_line in taxes["taxes"]:
-            tax = self.browse(tax_line["id"])
-            if tax.is_expensed_tax and tax.amount:
+            if tax_line["id"] in expensed_tax_ids:
                 amount = (
                     avatax_line and avatax_line.tax_amt_expense or tax_line["amount"]
                 )
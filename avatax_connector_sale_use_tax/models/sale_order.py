@@ -96,28 +96,32 @@ class SaleOrderLine(models.Model):
     @api.depends("tax_amt_expense")
     def _compute_amount(self):
         """
-        Compute the Tax Expense field
-        Needs to be done on the same method computing the tax amount.
-        Don't rely on Odoo MRO between Avatax and Expensed Tax
+        The Tax Expense fields are set by _get_avatax_amount_vals(),
+        from the same computation used for the collected tax amount.
         """
-        super()._compute_amount()
-        for line in self:
-            line.tax_expense = 0
-            has_expensed_tax = any(x.is_expensed_tax for x in line.tax_id)
-            if has_expensed_tax:
-                currency = line.order_id.currency_id or None
-                price = line._get_tax_price_unit()
-                tax_ids = line.tax_id.with_context(avatax_line=line)
-                taxes = tax_ids.compute_all(
+        # Prefetch the tax flags for the whole recordset
+        self.mapped("tax_id.is_expensed_tax")
+        return super()._compute_amount()
+
+    def _get_avatax_amount_vals(self, taxes):
+        vals = super()._get_avatax_amount_vals(taxes)
+        tax_expense = 0
+        if any(x.is_expensed_tax for x in self.tax_id):
+            price = self._get_tax_price_unit()
+            if price != self.price_unit * (1 - (self.discount or 0.0) / 100.0):
+                # Use Tax is computed on the purchase price, not the sale price
+                taxes = self.tax_id.with_context(avatax_line=self).compute_all(
                     price,
-                    currency,
-                    line.product_uom_qty,
-                    product=line.product_id,
-                    partner=line.order_id.partner_id,
+                    self.order_id.currency_id or None,
+                    self.product_uom_qty,
+                    product=self.product_id,
+                    partner=self.order_id.partner_id,
                 )
-                line.tax_expense = taxes.get("total_expense", 0) if taxes else 0
-            line.tax_total = line.price_tax + line.tax_expense
-        return
+            tax_expense = taxes.get("total_expense", 0) if taxes else 0
+        vals.update(
+            {"tax_expense": tax_expense, "tax_total": vals["price_tax"] + tax_expense}
+        )
+        return vals
 
     def _avatax_prepare_line(self, sign=1, doc_type=None):
         res = super()._avatax_prepare_line(sign=sign, doc_type=doc_type)
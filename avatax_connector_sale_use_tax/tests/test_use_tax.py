@@ -0,0 +1,142 @@
+from unittest.mock import patch
+from odoo.tests.common import TransactionCase
+
+
+class TestUseTax(TransactionCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.use_tax = self.env["account.tax"].create(
+            {
+                "name": "Test Use Tax 10%",
+                "type_tax_use": "sale",
+                "amount_type": "percent",
+                "amount": 10.0,
+                "is_expensed_tax": True,
+            }
+        )
+        self.partner = self.env["res.partner"].create({"name": "Use Tax Customer"})
+        self.product = self.env["product.product"].create(
+            {"name": "Use Tax Product", "type": "consu"}
+        )
+
+    def test_expense_on_purchase_price(self):
+        "Use Tax is expensed on the purchase price, not on the sale price"
+        order = self.env["sale.order"].create(
+            {
+                "partner_id": self.partner.id,
+                "order_line": [
+                    (
+                        0,
+                        0,
+                        {
+                            "product_id": self.product.id,
+                            "name": self.product.name,
+                            "product_uom_qty": 2,
+                            "product_uom": self.product.uom_id.id,
+                            "price_unit": 100.0,
+                            "purchase_price": 60.0,
+                            "tax_id": [(6, 0, self.use_tax.ids)],
+                        },
+                    )
+                ],
+            }
+        )
+        line = order.order_line
+        self.assertAlmostEqual(line.price_subtotal, 200.0)
+        self.assertAlmostEqual(line.price_tax, 0.0)
+        self.assertAlmostEqual(line.tax_expense, 12.0)
+        self.assertAlmostEqual(line.tax_total, 12.0)
+
+    def test_single_tax_computation(self):
+        "Line amounts and Tax Expense come from a single tax computation"
+        order = self.env["sale.order"].create(
+            {
+                "partner_id": self.partner.id,
+                "order_line": [
+                    (
+                        0,
+                        0,
+                        {
+                            "product_id": self.product.id,
+                            "name": self.product.name,
+                            "product_uom_qty": 2,
+                            "product_uom": self.product.uom_id.id,
+                            "price_unit": 100.0,
+                            "tax_id": [(6, 0, self.use_tax.ids)],
+                        },
+                    )
+                ],
+            }
+        )
+        line = order.order_line
+        line.purchase_price = 0.0  # Expensed on the sale price
+        AccountTax = type(self.env["account.tax"])
+        compute_all = AccountTax.compute_all
+        calls = []
+
+        def count_compute_all(taxes, *args, **kwargs):
+            calls.append(taxes)
+            return compute_all(taxes, *args, **kwargs)
+
+        with patch.object(AccountTax, "compute_all", count_compute_all):
+            line.price_unit = 50.0
+            self.assertAlmostEqual(line.price_subtotal, 100.0)
+        self.assertEqual(len(calls), 1)
+        self.assertAlmostEqual(line.tax_expense, 10.0)
+
+    def test_soap_invoice_expense(self):
+        "Tax lines computed for the SOAP API get the Tax Expense amount"
+        avatax = self.env["account.tax"].create(
+            {
+                "name": "Test Avatax",
+                "type_tax_use": "sale",
+                "amount_type": "percent",
+                "amount": 0.0,
+                "is_avatax": True,
+            }
+        )
+        account = self.env["account.account"].search(
+            [("internal_type", "=", "other")], limit=1
+        )
+        invoice = self.env["account.invoice"].create(
+            {
+                "partner_id": self.partner.id,
+                "account_id": self.partner.property_account_receivable_id.id,
+                "type": "out_invoice",
+                "invoice_line_ids": [
+                    (
+                        0,
+                        0,
+                        {
+                            "product_id": self.product.id,
+                            "name": self.product.name,
+                            "account_id": account.id,
+                            "quantity": 2,
+                            "price_unit": 100.0,
+                            "purchase_price": 60.0,
+                            "invoice_line_tax_ids": [(6, 0, self.use_tax.ids)],
+                        },
+                    )
+                ],
+                "tax_line_ids": [
+                    (
+                        0,
+                        0,
+                        {
+                            "name": avatax.name,
+                            "tax_id": avatax.id,
+                            "account_id": account.id,
+                            "manual": True,
+                        },
+                    )
+                ],
+            }
+        )
+        tax_grouped = invoice.get_taxes_values(contact_avatax=True)
+        use_tax_vals = [
+            x for x in tax_grouped.values() if x["tax_id"] == self.use_tax.id
+        ]
+        self.assertEqual(len(use_tax_vals), 1)
+        self.assertAlmostEqual(use_tax_vals[0]["amount"], 0.0)
+        self.assertAlmostEqual(use_tax_vals[0]["amount_tax_expense"], 12.0)